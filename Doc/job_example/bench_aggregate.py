@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Compare the built-in .agg stages of popype.py with the loops of
+count_calls.py and filter_by_arg_count.py, ported to Python 3, on synthetic
+rows like the ones of log_f_calls.cocci and log_f_args_count.cocci.
+
+    ./bench_aggregate.py [rows]"""
+
+import configparser, io, os, random, re, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "..", "docker"))
+import popype
+
+def count_calls(lines):
+    """The loop of count_calls.py"""
+
+    mydict = {}
+    regex = "(^pr_|^ata_|^dev|^fs_|^hid_|^net|^v4l)"
+    buckets = {"specialized_calls": 0, "printk_calls": 0, "other": 0}
+
+    for line in lines:
+        line = line[:-1]
+        func = line.split(",")[0]
+
+        if re.match(regex, func):
+            buckets["specialized_calls"] += 1
+        elif func == "printk":
+            buckets["printk_calls"] += 1
+        else:
+            buckets["other"] += 1
+
+        if func in mydict:
+            mydict[func] += 1
+        else:
+            mydict[func] = 1
+
+    return sorted(mydict.items()), sorted(buckets.items())
+
+def filter_by_arg_count(lines):
+    """The loop of filter_by_arg_count.py"""
+
+    mydict = {}
+    for line in lines:
+        func, n = line[:-1].split(",")[:2]
+        mydict.setdefault(func, set()).add(n)
+
+    return sorted(x for x in mydict if len(mydict[x]) >= 2)
+
+def aggregate(path, data):
+    """Run the .agg file at path on data. Return the output lines"""
+
+    conf = configparser.ConfigParser()
+    conf.read(path)
+
+    return popype.Aggregate(conf["aggregate"]).run(io.BytesIO(data))
+
+def timed(func, *args):
+    """Return the result of func(*args) and how long it took"""
+
+    start = time.time()
+    result = func(*args)
+
+    return result, time.time() - start
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    prefixes = ["pr_", "dev_", "net_", "printk", "foo_", "bar_", "ata_"]
+    funcs = [random.choice(prefixes) + str(x) for x in range(5000)]
+    funcs.append("printk")
+    data = "".join(random.choice(funcs) + "," + str(random.randint(1, 4)) +
+                   ",9,caller,drivers/x/file" + str(x % 997) + ".c,457,457\n"
+                   for x in range(rows))
+    lines = data.splitlines(keepends=True)
+    data = data.encode()
+
+    (calls, kinds), loop_time = timed(count_calls, lines)
+    agg_calls, agg_time = timed(aggregate, here + "/count_calls.agg", data)
+    assert agg_calls == [(k + "," + str(v) + "\n").encode() for k, v in calls]
+    print("count_calls:         loop %.2fs  agg %.2fs" % (loop_time, agg_time))
+
+    agg_kinds, agg_time = timed(aggregate, here + "/count_call_kinds.agg",
+                                data)
+    assert agg_kinds == [(k + "," + str(v) + "\n").encode() for k, v in kinds
+                         if v]
+    print("count_call_kinds:    loop %.2fs  agg %.2fs (same loop as above)" %
+          (loop_time, agg_time))
+
+    funcs, loop_time = timed(filter_by_arg_count, lines)
+    agg_funcs, agg_time = timed(aggregate, here + "/filter_by_arg_count.agg",
+                                data)
+    assert agg_funcs == [(x + "\n").encode() for x in funcs]
+    print("filter_by_arg_count: loop %.2fs  agg %.2fs" % (loop_time, agg_time))
+
+if __name__ == "__main__":
+    main()
@@ -19,13 +19,27 @@ __license__ = "GPLv2"
 __version__ = "Alpha 2"
 
 from configparser import ConfigParser, ExtendedInterpolation
-import filecmp, os, logging, subprocess
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from concurrent.futures.process import BrokenProcessPool
+import argparse, array, atexit, collections, copy, filecmp, gzip, hashlib
+import importlib.util, itertools, json, mmap, os, logging, multiprocessing
+import operator, re, resource, shutil, signal, socket, sqlite3, struct
+import subprocess, sys, threading, time, traceback, types, zlib
+import urllib.request
 
 # Some ugly globals
 CSP_CONF = "popype_conf"
 JOB_CONF = "job_conf"
+
+# Modules of the in-process stages loaded by this process, see
+# inprocess_stage()
+INPROC_MODULES = {}
 SCRIPT_DIR = "/"
 
+# First bytes of a stdout written by RecordWriter
+RECORDS_MAGIC = b"\0popype records 1\n"
+
 # Some logging functions
 def exit_error(msg):
     """Log the error and exit with -1"""
@@ -52,8 +66,14 @@ class GitRepoConfig:
     def __init__(self, repo_or_config, isrepo=False, isconfig=False):
         self.author_email = ""
         self.author_name = ""
+        self.batch_bytes = 0
+        self.batch_count = 1
+        self.batch_seconds = 0
         self.branch_for_write = ""
         self.compress = False
+        self.fetch = []
+        self.fetch_refs = []
+        self.reference = ""
         self.repo_dir = ""
         self.ssl_key = ""
         self.ssl_key_path = ""
@@ -76,6 +96,8 @@ class GitRepo:
         self.conf = GitRepoConfig(repo_or_config, isrepo, isconfig)
         self.exec_env = exec_env
         self.run = self.exec_env.run
+        self.batcher = CommitBatcher(self)
+        self.stale_deltas = set()
 
     def __iter__(self):
         # Do I need this?
@@ -92,6 +114,75 @@ class GitRepo:
 
         return self.next_checkout()
 
+    def next_checkout(self):
+        """Pop the next checkout target and checkout it on repo_dir"""
+
+        checkout = self.checkout_targets.pop(0)
+
+        self.reset_clean()
+        self.git_checkout(checkout, iscritical=True)
+
+        return checkout
+
+    def add_commit_push(self, env):
+        """Add the results of one stage to the index. Commit and push are up
+        to self.batcher, see CommitBatcher. The hacky detail: This is made for
+        the git_out repository."""
+
+        stage_dir = env.pipedir + "/" + env.pipeidx
+        files = ["script", self.exec_env.stdout_name, "stderr"]
+
+        # See Pipeline.delta_write(). The full stdout stays on the working
+        # tree for the stages and checkouts after this one.
+        if os.path.exists(stage_dir + "/stdout.delta"):
+            files[1] = "stdout.delta"
+            with self.batcher.lock:
+                self.run(stage_dir, "git rm -q --cached --ignore-unmatch " +
+                         self.exec_env.stdout_name)
+        elif stage_dir in self.stale_deltas:
+            # And the other way around, see prepare()
+            with self.batcher.lock:
+                self.run(stage_dir, "git rm -q --cached --ignore-unmatch "
+                         "stdout.delta")
+        self.stale_deltas.discard(stage_dir)
+
+        # stdout is compressed while being written, stderr is small
+        if self.conf.compress:
+            self.exec_env.compress(stage_dir + "/stderr")
+            files[2] += self.exec_env.codec.ext
+
+        if os.path.exists(stage_dir + "/metrics.json"):
+            files.append("metrics.json")
+
+        # See Pipeline.isdone()
+        if os.path.exists(env.pipedir + "/journal"):
+            files.append("../journal")
+
+        size = sum(os.path.getsize(stage_dir + "/" + x) for x in files
+                   if os.path.exists(stage_dir + "/" + x))
+
+        self.batcher.add(stage_dir, files, env.checkout + ": " + env.stage +
+                         " returned " + str(env.return_code), size)
+
+    def prepare(self, env):
+        """Create #PIPEDIR#/#PIPEIDX# and copy the script of the stage to it.
+        The hacky detail: This is made for the git_out repository."""
+
+        stage_dir = env.pipedir + "/" + env.pipeidx
+
+        self.exec_env.makedirs(stage_dir, iscritical=True)
+        self.exec_env.copy(SCRIPT_DIR + env.stage, stage_dir + "/script",
+                           iscritical=True)
+
+        # Results from a previous run can be hard links to StageCache entries.
+        # Unlink them instead of truncating them when writing the new ones.
+        for name in os.listdir(stage_dir):
+            if name.split(".")[0] in ["stdout", "stderr"]:
+                os.remove(stage_dir + "/" + name)
+                # It stays on git unless the stage saves a delta again
+                if name == "stdout.delta":
+                    self.stale_deltas.add(stage_dir)
+
     def reset_clean(self):
         """git reset --hard; git clean -f -x -d"""
 
@@ -120,26 +211,45 @@ class GitRepo:
 
         self.run(self.conf.repo_dir, "git clean " + opts)
 
-    def git_clone(self):
+    def git_clone(self, opts=""):
         """Guess what: git clone"""
 
-        self.run(self.conf.repo_dir, "git clone " + self.conf.repo_url + " .",
-                 iscritical=True)
+        if opts:
+            opts += " "
+
+        self.run(self.conf.repo_dir, "git clone " + opts + self.conf.repo_url +
+                 " .", iscritical=True)
+
+    def git_commit(self, opts, iscritical=False):
+        """Guess what: git commit opts"""
+
+        self.run(self.conf.repo_dir, "git commit " + opts, iscritical)
 
     def git_config(self, opts):
         """Guess what: git config opts"""
 
         self.run(self.conf.repo_dir, "git config " + opts, iscritical=True)
 
+    def git_fetch(self, opts, iscritical=False):
+        """Guess what: git fetch opts. Return $?"""
+
+        return self.run(self.conf.repo_dir, "git fetch " + opts,
+                        iscritical)[0]
+
     def git_init(self):
         """Guess what: do a git init"""
 
         self.run(self.conf.repo_dir, "git init", iscritical=True)
 
+    def git_pull(self, opts, iscritical=False):
+        """Guess what: git pull opts"""
+
+        return self.run(self.conf.repo_dir, "git pull " + opts, iscritical)[0]
+
     def git_push(self, opts, iscritical=False):
         """Guess what: git push opts"""
 
-        self.run(self.conf.repo_dir, "git push " + opts, iscritical)
+        return self.run(self.conf.repo_dir, "git push " + opts, iscritical)[0]
 
     def git_remote_update(self):
         """Guess what: do a git remote update"""
@@ -151,6 +261,41 @@ class GitRepo:
 
         self.run(self.conf.repo_dir, "git reset " + opts)
 
+    def git_worktree(self, opts, iscritical=False):
+        """Guess what: git worktree opts"""
+
+        self.run(self.conf.repo_dir, "git worktree " + opts, iscritical)
+
+    def worktree_add(self, path, checkout):
+        """Create a new working tree at path for checkout. All working trees
+        share the object store of repo_dir, so this is cheap compared to a new
+        clone."""
+
+        # Leftovers from a previous run would make git worktree add fail
+        self.exec_env.rmtree(path, iscritical=True)
+        self.git_worktree("prune")
+
+        self.git_worktree("add --detach " + path + " " + checkout,
+                          iscritical=True)
+
+    def worktree_remove(self, path):
+        """Delete the working tree at path"""
+
+        self.git_worktree("remove --force " + path)
+
+    def has_refs(self):
+        """Return True if all conf.fetch_refs are already in the repository"""
+
+        if not os.path.isdir(self.conf.repo_dir + "/.git"):
+            return False
+
+        for ref in self.conf.fetch_refs:
+            if self.run(self.conf.repo_dir, "git rev-parse -q --verify " + ref +
+                        "^{commit}")[0]:
+                return False
+
+        return True
+
     def isbranch(self, branch):
         """Return true if branch exist, False if not"""
 
@@ -190,7 +335,7 @@ class GitRepo:
             # Yes!
             if filecmp.cmp(dl_config_file_path, config_file_path):
                 # Cool the two config files are the same
-                self.git_remote_update()
+                self.fetch()
                 return
 
         # If we got here it means that or the config file is not there or it is
@@ -207,33 +352,77 @@ class GitRepo:
                            iscritical=True)
 
         self.git_init()
-        self.git_remote_update()
+
+        # Same as git clone --reference: objects already on the mirror are not
+        # fetched again
+        if self.conf.reference:
+            self.exec_env.create_file(self.conf.reference + "/objects\n",
+                                      repo_path +
+                                      "/.git/objects/info/alternates")
+
+        self.fetch()
+
+    def fetch(self):
+        """Fetch from the remotes of git_in according to conf.fetch. Empty
+        means git remote update. With refs, only the refs at conf.fetch_refs
+        are fetched, and with blobless, file contents are only downloaded when
+        a checkout needs them"""
+
+        if not self.conf.fetch:
+            self.git_remote_update()
+            return
+
+        git_opts = ""
+        if "blobless" in self.conf.fetch:
+            git_opts = "--filter=blob:none "
+
+        remotes = self.exec_env.check_output(self.conf.repo_dir,
+                                             "git remote").split()
+
+        if "refs" not in self.conf.fetch:
+            for remote in remotes:
+                self.git_fetch(git_opts + "--tags " + remote, iscritical=True)
+            return
+
+        for ref in self.conf.fetch_refs:
+            if not self.fetch_ref(ref, remotes, git_opts):
+                self.exec_env.exit("Could not fetch " + ref + " from any "
+                                   "remote")
+
+    def fetch_ref(self, ref, remotes, git_opts):
+        """Fetch ref, that can be remote/branch, a tag or a commit id, from
+        the first remote that has it. Return True if it worked"""
+
+        # remotes/linux-next/master or linux-next/master
+        parts = ref.split("/")
+        if parts[0] == "remotes":
+            parts = parts[1:]
+
+        if len(parts) > 1 and parts[0] in remotes:
+            branch = "/".join(parts[1:])
+            refspec = ("+refs/heads/" + branch + ":refs/remotes/" + parts[0] +
+                       "/" + branch)
+            return not self.git_fetch(git_opts + "--no-tags " + parts[0] + " " +
+                                      refspec)
+
+        # Tags are the common case, commit ids need the server to allow it
+        for refspec in ["+refs/tags/" + ref + ":refs/tags/" + ref, ref]:
+            for remote in remotes:
+                if not self.git_fetch(git_opts + "--no-tags " + remote + " " +
+                                      refspec):
+                    return True
+
+        return False
 
     def init_by_url(self):
         """Init a git repository from an url e.g. git clone url. The hacky
         detail: This is made for the git_out repository, the repository to which
         cloudspatch will write to."""
 
-        repo_url = self.conf.repo_url
         repo_dir = self.conf.repo_dir
-        key_path = self.conf.ssl_key_path
         branch = self.conf.branch_for_write
 
-        # Create ~/.ssh for id_rsa
-        key_dir = os.path.dirname(key_path)
-        self.exec_env.makedirs(key_dir)
-
-        # Save the id_rsa aka private key
-        # Why create a file at /tmp and then copy it to the destination folder?
-        # To have a log of what is going on. There isn't a method to create a
-        # file at exec_env
-        self.exec_env.create_file(self.conf.ssl_key, key_path)
-
-        # Fix private key permissions
-        self.exec_env.chmod("0600 " + key_path)
-
-        # This adds one entry to ~/.ssh/known_hosts
-        self.exec_env.ssh_handshake(repo_url)
+        self.ssh_setup()
 
         # This directory should not exist, delete it and create again
         self.exec_env.rmtree(repo_dir)
@@ -245,8 +434,14 @@ class GitRepo:
                         self.conf.author_email + "\"")
         self.git_config("--global push.default simple")
 
-        # Finally clone the directory
-        self.git_clone()
+        # Finally clone the directory. Only the last commit is needed for
+        # adding new results, and old results are not needed at all.
+        clone_opts = ""
+        if "shallow" in self.conf.fetch:
+            clone_opts = "--depth 1 --no-single-branch"
+        elif "blobless" in self.conf.fetch:
+            clone_opts = "--filter=blob:none"
+        self.git_clone(clone_opts)
 
         # Our branch: check if it exists, if not create it
         # Also create the directory tree and copy the script file
@@ -262,20 +457,332 @@ class GitRepo:
 
         self.git_push("--dry-run", iscritical=True)
 
+    def ssh_setup(self):
+        """Save the ssh key of the repository and add the git server to
+        ~/.ssh/known_hosts"""
+
+        key_path = self.conf.ssl_key_path
+
+        # Create ~/.ssh for id_rsa
+        key_dir = os.path.dirname(key_path)
+        self.exec_env.makedirs(key_dir)
+
+        # Save the id_rsa aka private key
+        # Why create a file at /tmp and then copy it to the destination folder?
+        # To have a log of what is going on. There isn't a method to create a
+        # file at exec_env
+        self.exec_env.create_file(self.conf.ssl_key, key_path)
+
+        # Fix private key permissions
+        self.exec_env.chmod("0600 " + key_path)
+
+        # This adds one entry to ~/.ssh/known_hosts
+        self.exec_env.ssh_handshake(self.conf.repo_url)
+
+    def snapshot(self, path):
+        """Clone the last commit of branch_for_write to path, and make it the
+        repo_dir, for reading the results without the init() of a job. Quiet,
+        the callers print their results on stdout. Remove path when done"""
+
+        self.ssh_setup()
+
+        self.exec_env.rmtree(path)
+        self.run(self.exec_env.tmp_dir, "git clone -q --depth 1 -b " +
+                 self.conf.branch_for_write + " " + self.conf.repo_url + " " +
+                 path + " > /dev/null", iscritical=True)
+
+        self.conf.repo_dir = path
+
     def set_checkout(self, checkout_csv):
         """Define the checkout targets"""
 
-        self.checkout_targets = [x.strip() for x in checkout_csv.split(",")]
+        self.checkout_targets = [x.strip() for x in checkout_csv.split(",")
+                                 if x.strip()]
+
+    def diff_names(self, commit_a, commit_b):
+        """Return the list of files that differ from commit_a to commit_b"""
+
+        git_cmd = ("git diff --name-only --no-renames " + commit_a + " " +
+                   commit_b)
+        names = self.exec_env.check_output(self.conf.repo_dir, git_cmd)
+
+        return [x for x in names.split("\n") if x]
+
+    def reorder_checkouts(self, window):
+        """Reorder checkout_targets so that each checkout writes as few files
+        as possible to the working tree. Starting from the oldest target, the
+        next one is the target that differs the least from the current one,
+        among the window targets closest to it in commit date. Return the
+        number of file writes saved."""
+
+        targets = self.checkout_targets
+        if len(targets) < 3:
+            return 0
+
+        dates = {}
+        for target in targets:
+            dates[target] = int(self.exec_env.check_output(
+                self.conf.repo_dir, "git log -1 --format=%ct " + target))
+
+        costs = {}
+        def cost(commit_a, commit_b):
+            pair = tuple(sorted([commit_a, commit_b]))
+            if pair not in costs:
+                costs[pair] = len(self.diff_names(commit_a, commit_b))
+            return costs[pair]
+
+        remaining = list(targets)
+        order = [min(remaining, key=lambda x: dates[x])]
+        remaining.remove(order[0])
+
+        while remaining:
+            current = order[-1]
+            candidates = sorted(remaining,
+                                key=lambda x: abs(dates[x] -
+                                                  dates[current]))[:window]
+            order.append(min(candidates, key=lambda x: cost(current, x)))
+            remaining.remove(order[-1])
+
+        before = sum(cost(a, b) for a, b in zip(targets, targets[1:]))
+        after = sum(cost(a, b) for a, b in zip(order, order[1:]))
+
+        # Never make it worse than what the user asked for
+        if after >= before:
+            logging.info("checkout order: kept, " + str(before) +
+                         " file writes")
+            return 0
+
+        logging.info("checkout order: " + ", ".join(order))
+        logging.info("checkout order: " + str(after) + " file writes instead "
+                     "of " + str(before) + ", " + str(before - after) +
+                     " saved")
+        self.checkout_targets = order
+
+        return before - after
+
+    def rev_list(self, opts):
+        """Return the output of git rev-list opts as a list"""
+
+        git_cmd = "git rev-list " + opts
+        commits = self.exec_env.check_output(self.conf.repo_dir, git_cmd)
+
+        return [x for x in commits.split("\n") if x]
+
+class CommitBatcher:
+    """Commit the results added to a GitRepo in batches, and push them on the
+    background. A batch is committed when it has batch_count results, when it
+    has batch_bytes bytes, or when batch_seconds have passed since its first
+    result, whatever happens first. Pushes run on a separate thread, and if
+    there are many commits waiting, a single push sends them all. flush() is
+    called at exit, so nothing is left behind. on_pushed() tells when what was
+    added is safe on the remote."""
+
+    # Pushes tried by push() before giving up
+    push_tries = 5
+
+    def __init__(self, git_repo):
+        self.first_time = 0
+        self.lock = threading.RLock()
+        self.pending = []
+        # on_pushed() callbacks of the pending results, and of the commits
+        # not pushed yet
+        self.pending_callbacks = []
+        self.commit_callbacks = []
+        self.push_needed = threading.Event()
+        self.pusher = None
+        self.repo = git_repo
+        self.size = 0
+        self.stop = False
+
+    def add(self, cwd, files, msg, size):
+        """git add files on cwd, and commit if the batch is full"""
+
+        with self.lock:
+            if not self.pusher:
+                self.start()
+
+            self.repo.run(cwd, "git add " + " ".join(files))
+
+            if not self.pending:
+                self.first_time = time.time()
+            self.pending.append(msg)
+            self.size += size
+
+            if self.isfull():
+                self.commit()
+
+    def commit(self):
+        """Commit the pending results and wake the pusher"""
+
+        with self.lock:
+            if not self.pending:
+                return
+
+            if len(self.pending) == 1:
+                msg = self.pending[0]
+            else:
+                msg = (str(len(self.pending)) + " results\n\n" +
+                       "\n".join(self.pending) + "\n")
+
+            msg_path = self.repo.exec_env.tmp_dir + "/commit_msg"
+            self.repo.exec_env.create_file(msg, msg_path)
+            self.repo.git_commit("-F " + msg_path)
+
+            self.pending = []
+            self.size = 0
+            self.commit_callbacks += self.pending_callbacks
+            self.pending_callbacks = []
+
+        self.push_needed.set()
+
+    def flush(self):
+        """Commit what is pending, stop the pusher and push for the last
+        time. Results that can't be pushed are an error"""
+
+        with self.lock:
+            if not self.pusher:
+                return
+
+            self.commit()
+            self.stop = True
+
+        self.push_needed.set()
+        self.pusher.join()
+        self.pusher = None
+
+        if not self.push():
+            exit_error("Results committed at " + self.repo.conf.repo_dir +
+                       " but not pushed")
+
+    def exit_flush(self):
+        """flush() at exit. exit() from an atexit function doesn't change
+        $?, so a failed flush() ends the process right there"""
+
+        try:
+            self.flush()
+        except SystemExit as error:
+            logging.shutdown()
+            os._exit(error.code or 1)
+
+    def on_pushed(self, callback):
+        """Call callback(), on the pusher thread, once everything added so far
+        is pushed. Right away if there is nothing waiting"""
+
+        with self.lock:
+            if not self.pusher:
+                callback()
+                return
+
+            if self.pending:
+                self.pending_callbacks.append(callback)
+                return
+
+            self.commit_callbacks.append(callback)
+
+        self.push_needed.set()
+
+    def isfull(self):
+        """Return True if the batch should be committed now"""
+
+        conf = self.repo.conf
+
+        if len(self.pending) >= conf.batch_count:
+            return True
+
+        if conf.batch_bytes and self.size >= conf.batch_bytes:
+            return True
+
+        if (conf.batch_seconds and
+                time.time() - self.first_time >= conf.batch_seconds):
+            return True
+
+        return False
+
+    def push(self):
+        """git push. If it fails because other popype instances pushed to the
+        same branch, git pull --rebase and try again, push_tries times at most.
+        The pipeline can keep adding results while pushing, but not while
+        pulling. Return True if the push succeeded"""
+
+        # Commits made from now on may not be part of this push
+        with self.lock:
+            callbacks = self.commit_callbacks
+            self.commit_callbacks = []
+
+        for _ in range(self.push_tries):
+            if not self.repo.git_push(""):
+                for callback in callbacks:
+                    callback()
+                return True
+
+            # Added but not committed results are stashed during the rebase,
+            # and a rebase that fails leaves the branch as it was
+            with self.lock:
+                if self.repo.git_pull("--rebase --autostash --no-edit"):
+                    self.repo.run(self.repo.conf.repo_dir,
+                                  "git rebase --abort")
+
+        with self.lock:
+            self.commit_callbacks = callbacks + self.commit_callbacks
+
+        return False
+
+    def push_loop(self):
+        """The pusher thread"""
+
+        timeout = self.repo.conf.batch_seconds or None
+
+        while True:
+            self.push_needed.wait(timeout)
+            if self.stop:
+                return
+
+            # Nothing added for a while, but the batch is old enough
+            with self.lock:
+                if self.pending and self.isfull():
+                    self.commit()
+
+            if not self.push_needed.is_set():
+                continue
+            self.push_needed.clear()
+
+            # A failed push is retried with the next one, or by flush()
+            self.push()
+
+    def start(self):
+        """Start the pusher thread"""
+
+        self.stop = False
+        self.pusher = threading.Thread(target=self.push_loop, daemon=True)
+        self.pusher.start()
+
+        atexit.register(self.exit_flush)
 
 class Env:
-    """Environment variables for runtime"""
-    pass
+    """Environment variables for runtime. There is one Env for each checkout
+    being processed, and it is shared by all stages of that checkout."""
+
+    def __init__(self):
+        self.checkout = ""
+        self.conf = None
+        self.env_run = None
+        self.pipedir = ""
+        self.pipeidx = ""
+        self.pipestderr = ""
+        self.pipestdout = ""
+        self.prev_pipedir = ""
+        self.return_code = 0
+        self.src_dir = ""
+        self.stage = ""
+        self.touched = None
+        self.tree = ""
 
 class Stage:
     """Stage of the pipeline"""
     def __init__(self, name):
         self.name = name
         self.env = None
+        self.jobs = 0
 
     def set_env(self, env):
         """Set env for Stage"""
@@ -284,55 +791,2440 @@ class Stage:
     def run(self):
         "Run the stage"
 
+        return self.env.env_run(self.env, self.command())
+
+    def command(self):
+        """Return the command line of the stage with the popype variables
+        replaced by the values at self.env"""
+
         if not self.env:
             exit_error(self.name + ": No environment found for running.")
 
         ext = self.name.split(".")[1]
-        pipe_par = self.env.conf.get("popype_args", ext)
+        pipe_par = self.env.conf.get("cmd_line_args", ext)
 
         pipe_par = pipe_par.replace("#PIPEIDX#", self.env.pipeidx)
         pipe_par = pipe_par.replace("#PIPEDIR#", self.env.pipedir)
-        pipe_par = pipe_par.replace("#PIPESTDOUT#", self.env.pipestdout)
+        # Compressed stdout is decompressed to the stdin of the stage
+        pipestdout = self.env.pipestdout
+        if pipestdout.endswith(tuple(Codec.exts.values())):
+            pipestdout = "/dev/stdin"
+        pipe_par = pipe_par.replace("#PIPESTDOUT#", pipestdout)
         pipe_par = pipe_par.replace("#PIPESTDERR#", self.env.pipestderr)
 
-        cmd = SCRIPT_DIR + self.name + " " + pipe_par
+        # Fewer spatch jobs, see MemoryBudget. The last -j wins.
+        if self.jobs:
+            pipe_par += " -j " + str(self.jobs)
+
+        return SCRIPT_DIR + self.name + " " + pipe_par
+
+class StageCache:
+    """Content addressed cache of stage results. The key of one result is
+    made of the git tree of the checkout, the contents of the stage script, the
+    [cmd_line_args] of the stage and the contents of the stdout of the previous
+    stage, see Pipeline.stage_key. Entries live at cache_dir/key/{stdout,
+    stderr}, and the least recently used ones are deleted when the cache gets
+    bigger than max_size bytes."""
+
+    def __init__(self, exec_env, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.exec_env = exec_env
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.misses = 0
+
+        self.exec_env.makedirs(self.cache_dir, iscritical=True)
+
+    @staticmethod
+    def file_hash(path):
+        """Return the sha256 of the contents of path"""
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as myfp:
+            for chunk in iter(lambda: myfp.read(1 << 20), b""):
+                sha.update(chunk)
+
+        return sha.hexdigest()
+
+    def get(self, key, stage_dir):
+        """If key is in the cache, hard link stdout and stderr to stage_dir and
+        return True. Return False otherwise"""
+
+        entry = self.cache_dir + "/" + key
+
+        with self.lock:
+            if not os.path.isdir(entry):
+                self.misses += 1
+                logging.info("cache miss " + key + " for " + stage_dir)
+                return False
+
+            self.hits += 1
+            # The mtime of the entry is what makes it recently used
+            os.utime(entry)
+
+            for name in [self.exec_env.stdout_name, "stderr"]:
+                try:
+                    os.link(entry + "/" + name, stage_dir + "/" + name)
+                except OSError:
+                    shutil.copyfile(entry + "/" + name, stage_dir + "/" + name)
+
+        logging.info("cache hit " + key + " for " + stage_dir)
+
+        return True
+
+    def put(self, key, stage_dir):
+        """Save stdout and stderr from stage_dir as the entry for key"""
+
+        entry = self.cache_dir + "/" + key
+        tmp_entry = entry + ".tmp" + str(threading.get_ident())
+
+        os.makedirs(tmp_entry, exist_ok=True)
+        for name in [self.exec_env.stdout_name, "stderr"]:
+            shutil.copyfile(stage_dir + "/" + name, tmp_entry + "/" + name)
+
+        with self.lock:
+            if os.path.isdir(entry):
+                shutil.rmtree(tmp_entry)
+            else:
+                os.rename(tmp_entry, entry)
+
+            self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits on
+        max_size. Call it holding self.lock"""
+
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            entry = self.cache_dir + "/" + key
+            if ".tmp" in key or not os.path.isdir(entry):
+                continue
+
+            size = sum(os.path.getsize(entry + "/" + x)
+                       for x in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+
+        entries.sort()
+        while total > self.max_size and entries:
+            _, size, entry = entries.pop(0)
+            shutil.rmtree(entry)
+            total -= size
+            logging.info("cache evict " + entry)
+
+    def log_stats(self):
+        """Log the hit and miss counters"""
+
+        logging.info("cache: " + str(self.hits) + " hits, " +
+                     str(self.misses) + " misses")
+
+class ShardCosts:
+    """Seconds that each file took on the previous runs of the sharded stages,
+    see Pipeline.shard_run. Saved as JSON at path, as {stage: {file: seconds}}.
+    Files never seen before are estimated by their size."""
+
+    def __init__(self, path):
+        self.costs = {}
+        self.lock = threading.Lock()
+        self.path = path
+
+        if os.path.exists(path):
+            with open(path) as costs_fp:
+                self.costs = json.load(costs_fp)
+
+    def estimate(self, stage, src_dir, files):
+        """Return the list of (file, cost) for files of src_dir"""
+
+        with self.lock:
+            known = dict(self.costs.get(stage, {}))
+
+        sizes = [max(os.lstat(src_dir + "/" + path).st_size, 1)
+                 for path in files]
+
+        # Seconds per byte of the files already seen, to compare them with
+        # the new ones
+        rate = 1
+        known_size = sum(size for path, size in zip(files, sizes)
+                         if path in known)
+        known_cost = sum(known[path] for path in files if path in known)
+        if known_size and known_cost:
+            rate = known_cost / known_size
+
+        return [(path, known.get(path, size * rate))
+                for path, size in zip(files, sizes)]
+
+    @staticmethod
+    def partition(pairs, count):
+        """Split pairs, a list of (file, cost), in up to count lists of
+        consecutive pairs of about the same total cost"""
+
+        total = sum(cost for _, cost in pairs)
+        shards = [[]]
+        done = 0
+
+        for pair in pairs:
+            # The next shard starts when this one has its share
+            if (shards[-1] and len(shards) < count and
+                    done >= total * len(shards) / count):
+                shards.append([])
+            shards[-1].append(pair)
+            done += pair[1]
+
+        return shards
+
+    def update(self, stage, times):
+        """Learn from times, a list of (pairs, wall_time) of the shards of a
+        run. The wall_time of a shard is split among its files in proportion to
+        their estimates"""
+
+        with self.lock:
+            costs = self.costs.setdefault(stage, {})
+
+            for pairs, wall_time in times:
+                estimate = sum(cost for _, cost in pairs)
+                for path, cost in pairs:
+                    costs[path] = wall_time * cost / estimate
+
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as costs_fp:
+                json.dump(self.costs, costs_fp)
+            os.replace(tmp_path, self.path)
+
+class MemoryBudget:
+    """Admission control of stage processes by memory. The peak RSS of one
+    process of each stage is learned from the metrics of its previous runs,
+    and saved as JSON at path, as {stage: bytes}. A stage starts only when the
+    peak RSS of all its processes fits on what is left of budget bytes, and
+    waits for the others otherwise. Stages that run many jobs, as spatch -j,
+    are started with fewer jobs instead of waiting, if that makes them fit,
+    but with no more than half of what is free while other stages run."""
+
+    def __init__(self, path, budget):
+        self.budget = budget
+        self.cond = threading.Condition()
+        self.path = path
+        self.peaks = {}
+        self.used = 0
+
+        if os.path.exists(path):
+            with open(path) as peaks_fp:
+                self.peaks = json.load(peaks_fp)
+
+    def peak(self, name):
+        """Return the peak RSS of one process of stage name. Stages never seen
+        are as big as the biggest one seen"""
+
+        with self.cond:
+            return self.peaks.get(name, max(self.peaks.values(), default=0))
+
+    def admit(self, names, processes=1, jobs=0):
+        """Wait until the stages on names, that run at the same time, fit on
+        the budget, and reserve their memory. Each one runs processes
+        processes, each with jobs jobs, 0 if that can't be changed. Return the
+        jobs to use and the bytes reserved, for release()"""
+
+        label = " | ".join(names)
+        need = sum(self.peak(name) for name in names) * processes
+        waiting = False
+
+        with self.cond:
+            while True:
+                free = self.budget - self.used
+                if need * max(jobs, 1) <= free:
+                    break
+
+                # What is left is for the stages after this one too
+                fit = free // need
+                if self.used:
+                    fit = max(fit // 2, 1)
+                if jobs > 1 and need <= free:
+                    logging.info("memory: " + label + " runs with -j " +
+                                 str(fit) + " instead of " + str(jobs) +
+                                 ", " + str(free >> 20) + " MiB free")
+                    jobs = fit
+                    break
+
+                # Nothing else to wait for
+                if not self.used:
+                    if jobs > 1:
+                        jobs = 1
+                    log_warn("memory: " + label + " needs " +
+                             str(need * max(jobs, 1) >> 20) + " MiB, more "
+                             "than the budget of " + str(self.budget >> 20) +
+                             " MiB")
+                    break
+
+                if not waiting:
+                    logging.info("memory: " + label + " waits for " +
+                                 str(need * max(jobs, 1) >> 20) + " MiB, " +
+                                 str(free >> 20) + " MiB free")
+                    waiting = True
+                self.cond.wait()
+
+            reserved = need * max(jobs, 1)
+            self.used += reserved
+
+        return jobs, reserved
+
+    def release(self, reserved):
+        """Give back the bytes reserved by admit()"""
+
+        with self.cond:
+            self.used -= reserved
+            self.cond.notify_all()
+
+    def update(self, name, max_rss, processes=1):
+        """Learn the peak RSS of stage name from the max_rss of a run with
+        processes processes"""
+
+        with self.cond:
+            self.peaks[name] = max_rss // processes
+
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as peaks_fp:
+                json.dump(self.peaks, peaks_fp)
+            os.replace(tmp_path, self.path)
+
+def sqlite_connect(db_path):
+    """Return a new connection to the SQLite database at db_path, in autocommit
+    mode and waiting for the locks of other processes. SQLite connections can't
+    be shared by threads"""
+
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA busy_timeout = 60000")
+
+    return conn
+
+class TaskQueue:
+    """Queue of checkouts shared by many popype instances, possibly on many
+    servers. Tasks are leased instead of taken: a worker that does not renew its
+    lease before lease_time seconds loses the task to the next worker asking
+    for one, so the checkouts of dead workers are not lost. The queue is a
+    SQLite database, and all instances must be able to open db_path."""
+
+    def __init__(self, db_path, lease_time):
+        self.db_path = db_path
+        self.lease_time = lease_time
+
+        conn = sqlite_connect(self.db_path)
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS tasks ("
+                         "checkout TEXT PRIMARY KEY, "
+                         "state TEXT NOT NULL DEFAULT 'pending', "
+                         "worker TEXT, "
+                         "lease_until REAL NOT NULL DEFAULT 0, "
+                         "attempts INTEGER NOT NULL DEFAULT 0)")
+        finally:
+            conn.close()
+
+    def add(self, checkouts):
+        """Add checkouts to the queue. Checkouts already there are ignored"""
+
+        conn = sqlite_connect(self.db_path)
+        try:
+            conn.executemany("INSERT OR IGNORE INTO tasks (checkout) "
+                             "VALUES (?)", [(x,) for x in checkouts])
+        finally:
+            conn.close()
+
+    def lease(self, worker):
+        """Lease the next pending checkout, or one with an expired lease, to
+        worker. Return the checkout or None if there is nothing to do"""
+
+        conn = sqlite_connect(self.db_path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT checkout FROM tasks "
+                               "WHERE state = 'pending' OR "
+                               "(state = 'running' AND lease_until < ?) "
+                               "ORDER BY rowid LIMIT 1",
+                               (time.time(),)).fetchone()
+            if row:
+                conn.execute("UPDATE tasks SET state = 'running', "
+                             "worker = ?, lease_until = ?, "
+                             "attempts = attempts + 1 WHERE checkout = ?",
+                             (worker, time.time() + self.lease_time, row[0]))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        if not row:
+            return None
+
+        logging.info("queue: " + worker + " leased " + row[0])
+
+        return row[0]
+
+    def renew(self, checkout, worker):
+        """Extend the lease of worker on checkout"""
+
+        conn = sqlite_connect(self.db_path)
+        try:
+            conn.execute("UPDATE tasks SET lease_until = ? "
+                         "WHERE checkout = ? AND worker = ? AND "
+                         "state = 'running'",
+                         (time.time() + self.lease_time, checkout, worker))
+        finally:
+            conn.close()
+
+    def done(self, checkout, worker):
+        """Mark checkout as done"""
+
+        conn = sqlite_connect(self.db_path)
+        try:
+            conn.execute("UPDATE tasks SET state = 'done', worker = ? "
+                         "WHERE checkout = ?", (worker, checkout))
+        finally:
+            conn.close()
+
+        logging.info("queue: " + worker + " finished " + checkout)
+
+    def status(self):
+        """Return a dict state: number of tasks"""
+
+        conn = sqlite_connect(self.db_path)
+        try:
+            rows = conn.execute("SELECT state, COUNT(*) FROM tasks "
+                                "GROUP BY state").fetchall()
+        finally:
+            conn.close()
+
+        return dict(rows)
+
+class OutputIndex:
+    """Index of the stdout of the stages of all checkouts, for finding which
+    checkouts and stages have rows for a given first CSV field, e.g. a
+    function name, or for a given file, without reading every stdout. It is a
+    SQLite database at db_path, with the number of rows of each key and of each
+    file per checkout and stage. Both tables are clustered by what is looked
+    up, so a lookup reads only a few pages."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+        conn = sqlite_connect(self.db_path)
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS outputs ("
+                         "id INTEGER PRIMARY KEY, "
+                         "checkout TEXT NOT NULL, "
+                         "stage TEXT NOT NULL, "
+                         "UNIQUE (checkout, stage))")
+            for table, column in [("keys", "key"), ("files", "file")]:
+                conn.execute("CREATE TABLE IF NOT EXISTS " + table + " (" +
+                             column + " TEXT NOT NULL, "
+                             "output INTEGER NOT NULL, "
+                             "rows INTEGER NOT NULL, "
+                             "PRIMARY KEY (" + column + ", output)) "
+                             "WITHOUT ROWID")
+                conn.execute("CREATE INDEX IF NOT EXISTS " + table +
+                             "_output ON " + table + " (output)")
+        finally:
+            conn.close()
+
+    def add(self, checkout, stage, lines, column=None):
+        """Index lines, the stdout of stage for checkout, replacing what was
+        there. column is the index of the file name on each row, if any"""
+
+        keys = {}
+        files = {}
+        for line in lines:
+            if not line.strip():
+                continue
+            fields = line.rstrip("\n").split(",")
+            keys[fields[0]] = keys.get(fields[0], 0) + 1
+
+            if column is not None and len(fields) > column:
+                name = fields[column]
+                if name.startswith("./"):
+                    name = name[2:]
+                files[name] = files.get(name, 0) + 1
+
+        conn = sqlite_connect(self.db_path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT OR IGNORE INTO outputs (checkout, stage) "
+                         "VALUES (?, ?)", (checkout, stage))
+            output = conn.execute("SELECT id FROM outputs WHERE checkout = ? "
+                                  "AND stage = ?",
+                                  (checkout, stage)).fetchone()[0]
+            for table, counts in [("keys", keys), ("files", files)]:
+                conn.execute("DELETE FROM " + table + " WHERE output = ?",
+                             (output,))
+                conn.executemany("INSERT INTO " + table + " VALUES (?, ?, ?)",
+                                 [(x, output, counts[x]) for x in counts])
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        logging.info("index: " + str(len(keys)) + " keys and " +
+                     str(len(files)) + " files of " + stage + " for " +
+                     checkout)
+
+    def isindexed(self, checkout, stage):
+        """Return True if stage for checkout is on the index"""
+
+        conn = sqlite_connect(self.db_path)
+        try:
+            row = conn.execute("SELECT id FROM outputs WHERE checkout = ? AND "
+                               "stage = ?", (checkout, stage)).fetchone()
+        finally:
+            conn.close()
+
+        return row is not None
+
+    def query(self, column, value):
+        """Return the list of (checkout, stage, rows) with rows for value.
+        column is key, for the first CSV field, or file"""
+
+        table = {"key": "keys", "file": "files"}[column]
+
+        conn = sqlite_connect(self.db_path)
+        try:
+            rows = conn.execute("SELECT outputs.checkout, outputs.stage, " +
+                                table + ".rows FROM " + table + " JOIN "
+                                "outputs ON outputs.id = " + table +
+                                ".output WHERE " + table + "." + column +
+                                " = ? ORDER BY outputs.checkout, "
+                                "outputs.stage", (value,)).fetchall()
+        finally:
+            conn.close()
+
+        return rows
+
+class BlobMemo:
+    """Results of stages that analyze each file on its own, per git blob.
+    Most files are the same from one checkout to the next, and so is what
+    the stage says about them: it only has to run on the blobs it has not
+    seen, see Pipeline.blob_run. It is a SQLite database at db_path with the
+    rows of each blob for each stage key, where the stage key is the one of
+    Pipeline.stage_key, without the git tree."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+
+        conn = sqlite_connect(self.db_path)
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS blobs ("
+                         "key TEXT NOT NULL, "
+                         "blob TEXT NOT NULL, "
+                         "rows TEXT NOT NULL, "
+                         "PRIMARY KEY (key, blob)) WITHOUT ROWID")
+        finally:
+            conn.close()
+
+    def get(self, key, blobs):
+        """Return a dict with the rows of the blobs on blobs known for key"""
+
+        blobs = list(blobs)
+        known = {}
+
+        conn = sqlite_connect(self.db_path)
+        try:
+            # SQLite has a limit on the number of parameters
+            for idx in range(0, len(blobs), 500):
+                chunk = blobs[idx:idx + 500]
+                known.update(conn.execute(
+                    "SELECT blob, rows FROM blobs WHERE key = ? AND blob IN "
+                    "(" + ",".join("?" * len(chunk)) + ")", [key] + chunk))
+        finally:
+            conn.close()
+
+        self.hits += len(known)
+        self.misses += len(blobs) - len(known)
+
+        return known
+
+    def put(self, key, rows_of):
+        """Save rows_of, a dict with the rows of each blob, for key"""
+
+        conn = sqlite_connect(self.db_path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)",
+                             [(key, blob, rows) for blob, rows in
+                              rows_of.items()])
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def log_stats(self):
+        """Log the hit and miss counters"""
+
+        logging.info("blobs: " + str(self.hits) + " hits, " +
+                     str(self.misses) + " misses")
+
+class Aggregate:
+    """Built-in aggregation stages, the stages named *.agg. The .agg file is
+    not a script but a config file with an [aggregate] section:
+
+        op: group_count, distinct, regex_bucket or top_k
+        key: column of the CSV rows to group by, 0 by default
+        value: for distinct, column whose distinct values are counted per key
+        buckets: for regex_bucket, name: regex, ... Keys are counted on the
+                 first bucket whose regex they match, or on other
+        k: for top_k, how many keys with the highest counts
+        min: only keys counted at least min times, 1 by default
+        keys_only: yes to print only the keys
+
+    The output is key,count sorted by key, or by count for top_k. Rows are
+    read in large batches, split with bytes.split() and reduced with
+    Counter.update() and set.update(), that loop in C, with no str decoding and
+    no Python function call per row. regex_bucket matches each distinct key
+    once, not each row."""
+
+    ops = ["group_count", "distinct", "regex_bucket", "top_k"]
+
+    def __init__(self, section):
+        self.op = section.get("op", "")
+        if self.op not in self.ops:
+            raise ValueError("op must be one of " + ", ".join(self.ops))
+
+        self.buckets = []
+        for item in section.get("buckets", "").split(","):
+            if item.strip():
+                name, regex = item.split(":", 1)
+                self.buckets.append((name.strip().encode(),
+                                     re.compile(regex.strip().encode())))
+        self.k = section.getint("k", 10)
+        self.key = section.getint("key", 0)
+        self.keys_only = section.getboolean("keys_only", False)
+        self.min = section.getint("min", 1)
+        self.value = section.getint("value", 1)
+
+    def reduce(self, rows, counts, pairs):
+        """Add rows, a batch of CSV rows without the newline, to counts or,
+        for distinct, to pairs"""
+
+        key = self.key
+        value = self.value
+        last = max(key, value if self.op == "distinct" else 0)
+
+        # No per row function calls other than split, that is what counts
+        try:
+            if self.op == "distinct":
+                values = [(x[key], x[value]) for x in
+                          (row.split(b",", last + 1) for row in rows)]
+            else:
+                values = [row.split(b",", key + 1)[key] for row in rows]
+        except IndexError:
+            # Rows without enough columns are not counted
+            fields = [x for x in [row.split(b",", last + 1) for row in rows]
+                      if len(x) > last]
+            if self.op == "distinct":
+                values = [(x[key], x[value]) for x in fields]
+            else:
+                values = [x[key] for x in fields]
+
+        if self.op == "distinct":
+            pairs.update(values)
+        else:
+            counts.update(values)
+
+    def run(self, in_fp):
+        """Aggregate the rows read from in_fp. Return the output lines"""
+
+        counts = collections.Counter()
+        pairs = set()
+
+        # Batches end at a newline, the rest goes to the next one
+        rest = b""
+        for chunk in iter(lambda: in_fp.read(1 << 22), b""):
+            chunk = rest + chunk
+            end = chunk.rfind(b"\n") + 1
+            rest = chunk[end:]
+            if end:
+                self.reduce(chunk[:end - 1].split(b"\n"), counts, pairs)
+        if rest:
+            self.reduce([rest], counts, pairs)
+
+        if self.op == "distinct":
+            counts.update(map(operator.itemgetter(0), pairs))
+
+        counts.pop(None, None)
+        counts.pop(b"", None)
+
+        if self.op == "regex_bucket":
+            buckets = collections.Counter()
+            for key, count in counts.items():
+                name = next((name for name, regex in self.buckets
+                             if regex.search(key)), b"other")
+                buckets[name] += count
+            counts = buckets
+
+        if self.op == "top_k":
+            items = counts.most_common(self.k)
+        else:
+            items = sorted(counts.items())
+
+        return [key + b"\n" if self.keys_only else
+                key + b"," + str(count).encode() + b"\n"
+                for key, count in items if count >= self.min]
+
+def parse_schema(schema):
+    """Return the list of [name, type] of schema, a string like "func:str,
+    line:int". Types are str, int and float, str if not given."""
+
+    fields = []
+    for item in schema.split(","):
+        name, _, kind = item.partition(":")
+        kind = kind.strip() or "str"
+        if kind not in RecordWriter.formats:
+            exit_error("Unknown type " + kind + " on schema " + schema)
+        fields.append([name.strip(), kind])
+
+    return fields
+
+class RecordWriter:
+    """Write records, tuples with the fields of schema, as the stdout of a
+    stage listed at [pipeline] records. The stdout starts with RECORDS_MAGIC
+    and the schema as JSON on one line, followed by blocks of up to
+    block_size records. A block is its length and its number of records, then
+    each field of all its records in a row: int and float as 8 bytes little
+    endian, str joined by \\0 and prefixed by their length. Reading a block
+    is a few C calls, not a split() and a conversion for each field of each
+    line. From a .py or @script:python@ stage:
+
+        sys.path.insert(0, "/")
+        import popype
+        out = popype.RecordWriter(sys.stdout.buffer, "func:str, line:int")
+        out.write(("printk", 457))
+        out.close()"""
+
+    block_size = 8192
+    formats = {"str": "", "int": "q", "float": "d"}
+    length = struct.Struct("<II")
+
+    def __init__(self, out_fp, schema):
+        self.fields = parse_schema(schema)
+        self.out_fp = out_fp
+        self.records = []
+
+        out_fp.write(RECORDS_MAGIC + json.dumps(self.fields).encode() + b"\n")
+
+    def write(self, record):
+        """Write one record"""
+
+        self.records.append(record)
+        if len(self.records) >= self.block_size:
+            self.write_block()
+
+    def write_block(self):
+        """Write the records kept by write()"""
+
+        if not self.records:
+            return
+
+        columns = []
+        for (_, kind), column in zip(self.fields, zip(*self.records)):
+            if kind == "str":
+                data = "\0".join(column).encode()
+                columns.append(struct.pack("<I", len(data)) + data)
+            else:
+                data = array.array(self.formats[kind], column)
+                if sys.byteorder == "big":
+                    data.byteswap()
+                columns.append(data.tobytes())
+
+        data = b"".join(columns)
+        self.out_fp.write(self.length.pack(len(data), len(self.records)) +
+                          data)
+        self.records = []
+
+    def close(self):
+        """Write what is left and flush"""
+
+        self.write_block()
+        self.out_fp.flush()
+
+class RecordReader:
+    """Iterate over the records of the stdout of a stage on in_fp, as tuples,
+    see RecordWriter. The stdout of a stage that writes text, e.g. one that is
+    not at [pipeline] records, is split on commas, and converted to the types
+    of schema if given, so the same reader works for both."""
+
+    def __init__(self, in_fp, schema=None):
+        self.fields = parse_schema(schema) if schema else None
+        self.in_fp = in_fp
+
+        self.head = in_fp.read(len(RECORDS_MAGIC))
+        self.isrecords = self.head == RECORDS_MAGIC
+        if self.isrecords:
+            self.fields = json.loads(in_fp.readline())
 
-        self.env.env_run(self.env, cmd)
+    def __iter__(self):
+        if not self.isrecords:
+            yield from self.from_text()
+            return
+
+        length = RecordWriter.length
+        while True:
+            head = self.in_fp.read(length.size)
+            if len(head) < length.size:
+                return
+            size, count = length.unpack(head)
+            data = self.in_fp.read(size)
+
+            columns = []
+            pos = 0
+            for _, kind in self.fields:
+                if kind == "str":
+                    end = pos + 4 + struct.unpack_from("<I", data, pos)[0]
+                    columns.append(data[pos + 4:end].decode().split("\0"))
+                else:
+                    column = array.array(RecordWriter.formats[kind])
+                    end = pos + count * column.itemsize
+                    column.frombytes(data[pos:end])
+                    if sys.byteorder == "big":
+                        column.byteswap()
+                    columns.append(column)
+                pos = end
+
+            yield from zip(*columns)
+
+    def raw_lines(self):
+        """Iterate over the lines of a text stdout, as bytes"""
+
+        # The first bytes were read looking for RECORDS_MAGIC
+        lines = self.head.split(b"\n")
+        for line in lines[:-1]:
+            yield line + b"\n"
+        line = lines[-1] + self.in_fp.readline()
+        if line:
+            yield line
+
+        yield from self.in_fp
+
+    def from_text(self):
+        """Iterate over the records of a text stdout"""
+
+        kinds = {"int": int, "float": float}
+        convs = [kinds.get(kind) for _, kind in self.fields or []]
+
+        for line in self.raw_lines():
+            fields = line.decode().rstrip("\n").split(",")
+            yield tuple(conv(x) if conv and x else x for x, conv in
+                        itertools.zip_longest(fields, convs[:len(fields)]))
+
+    def lines(self):
+        """Iterate over the records as CSV text lines"""
+
+        if not self.isrecords:
+            for line in self.raw_lines():
+                yield line.decode()
+            return
+
+        for record in self:
+            yield ",".join(str(x) for x in record) + "\n"
+
+class Lookup:
+    """Set of keys on a file, for membership tests without loading it. The
+    file is mmap()ed, so all the processes using it, e.g. the -j workers of
+    spatch, share the same pages of the page cache, and opening it costs
+    nothing. popype writes one for the stages at [pipeline] lookup, see
+    Pipeline.lookup_build. From @initialize:python@:
+
+        sys.path.insert(0, "/")
+        import popype
+        myset = popype.Lookup(pipedir + "/0/lookup")
+
+    and then log_func in myset. The file is magic, the number of keys and
+    of slots, the slots, and the keys. It is a hash table with linear
+    probing: each slot has the start and the end of a key, and the slot of a
+    key is its crc32, the same for all processes, modulo the slots."""
+
+    magic = b"popype lookup 1\n"
+    head = struct.Struct("<QQ")
+
+    def __init__(self, path):
+        with open(path, "rb") as lookup_fp:
+            self.map = mmap.mmap(lookup_fp.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+
+        if self.map[:len(self.magic)] != self.magic:
+            raise ValueError(path + " is not a lookup file")
+
+        self.count, self.slots = self.head.unpack_from(self.map,
+                                                       len(self.magic))
+        self.table = len(self.magic) + self.head.size
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        key = key.encode() if isinstance(key, str) else key
+
+        slot = zlib.crc32(key) % self.slots
+        while True:
+            start, end = self.head.unpack_from(self.map, self.table +
+                                               slot * self.head.size)
+            if not end:
+                return False
+            if self.map[start:end] == key:
+                return True
+            slot = (slot + 1) % self.slots
+
+    def close(self):
+        """Unmap the file"""
+
+        self.map.close()
+
+    @classmethod
+    def write(cls, path, keys):
+        """Save keys, an iterable of bytes, as a lookup file at path. Readers
+        that have the old one open keep it."""
+
+        keys = set(keys)
+        keys.discard(b"")
+
+        # Half empty, so a miss ends soon
+        slots = 2 * len(keys) + 1
+        table = array.array("Q", bytes(16 * slots))
+        offset = len(cls.magic) + cls.head.size * (slots + 1)
+        for key in keys:
+            slot = zlib.crc32(key) % slots
+            while table[2 * slot + 1]:
+                slot = (slot + 1) % slots
+            table[2 * slot] = offset
+            table[2 * slot + 1] = offset + len(key)
+            offset += len(key)
+        if sys.byteorder == "big":
+            table.byteswap()
+
+        with open(path + ".tmp", "wb") as lookup_fp:
+            lookup_fp.write(cls.magic + cls.head.pack(len(keys), slots))
+            lookup_fp.write(table.tobytes())
+            lookup_fp.writelines(keys)
+        os.replace(path + ".tmp", path)
 
 class Pipeline:
     """This is not like a pipe from Bash. Instead of doing stdout to stdin magic
     using real, and in memory pipes, stdout and stderr are saved to disk, and
-    then full path to these files are passed around."""
-
-    def __init__(self):
-        self.env = None
+    then full path to these files are passed around. The exception are the
+    stages declared streamable at [pipeline], see stream_run()."""
 
+    def __init__(self, job_conf=JOB_CONF):
         self.exe = ExecTools()
-        self.job = JobConfig()
-
-        self.pipe_idx = 0
-        self.pipe_dir = None
-        self.prev_stdout = None
-        self.prev_stderr = None
-
-        self.stages = [Stage(x.strip()) for x in
-                       self.job.pipeline_str.split("|")]
-        self.stage_count = len(self.pipeline_stages)
-
-    def pipeline_run(self):
-        """The main loop of the pipeline"""
-
-        for checkout in self.conf.git_in.checkouts(self.env):
-            self.env.checkout = checkout
-            for stage in self.stages():
-                self.env.stage = stage
-                self.conf.git_out.prepare(self.env)
-                self.env.return_code = self.run(stage)
-                self.conf.git_out.add_commit_push(self.env)
-                if self.env.return_code < 0:
-                    log_warn("Error running " + self.env.stage + " for " +
-                            self.env.checkout)
-                    break
+        self.job = JobConfig(self.exe, job_conf)
+
+        # git_out has a single index and a single branch: only one checkout at
+        # a time is allowed to commit to it
+        self.out_lock = threading.Lock()
+
+        self.metrics = []
+
+        self.cache = None
+        if self.job.cache_dir:
+            self.cache = StageCache(self.exe, self.job.cache_dir,
+                                    self.job.cache_size)
+
+        self.shard_costs = None
+        if self.job.shards > 1:
+            self.shard_costs = ShardCosts(self.job.shard_costs)
+
+        # [git_out] delta: delta_prev[checkout] is the checkout whose output
+        # is the reference for the deltas of checkout. On parallel mode,
+        # delta_done has an Event for each checkout, set when it finishes,
+        # and delta_failed the checkouts that didn't get to the end.
+        self.delta_prev = {}
+        self.delta_done = {}
+        self.delta_failed = set()
+
+        # restored[path] is the hash of the stdout at path as the stage wrote
+        # it, for the ones rebuilt from the deltas, see restore()
+        self.restored = {}
+
+        self.index = None
+        if self.job.index_db:
+            self.index = OutputIndex(self.job.index_db)
+
+        self.memory = None
+        if self.job.memory_budget:
+            self.memory = MemoryBudget(self.job.memory_peaks,
+                                       self.job.memory_budget)
+
+        self.blobs = None
+        if self.job.blob_db:
+            self.blobs = BlobMemo(self.job.blob_db)
+
+        # See records_text()
+        self.text_lock = threading.Lock()
+
+        # Worker processes for [pipeline] inprocess, started when needed
+        self.py_lock = threading.Lock()
+        self.py_pool = None
+
+        self.stages = [x.strip() for x in self.job.pipeline_str.split("|")]
+        self.stage_count = len(self.stages)
+
+        # Each stage depends on the stage before it, unless [pipeline] inputs
+        # says otherwise. inputs[idx] is the stage whose stdout is the
+        # #PIPESTDOUT# of stage idx, or None, and deps[idx] are the stages
+        # that have to finish before stage idx starts.
+        self.inputs = [idx - 1 if idx else None
+                       for idx in range(self.stage_count)]
+        self.deps = [[idx - 1] if idx else [] for idx in
+                     range(self.stage_count)]
+        for name, dep_names in self.job.stage_inputs.items():
+            if name not in self.stages:
+                exit_error("[pipeline] inputs: " + name + " is not a stage")
+            idx = self.stages.index(name)
+
+            self.deps[idx] = []
+            for dep_name in dep_names:
+                if dep_name == "none":
+                    continue
+                if dep_name not in self.stages[:idx]:
+                    exit_error("[pipeline] inputs: " + dep_name + " must be "
+                               "a stage before " + name)
+                self.deps[idx].append(self.stages.index(dep_name))
+
+            self.inputs[idx] = None
+            if dep_names[0] != "none":
+                self.inputs[idx] = self.deps[idx][0]
+
+        for name in self.job.blob_stages:
+            if name not in self.job.file_columns:
+                exit_error("[blobs] stages: " + name + " must be at "
+                           "[pipeline] file_column")
+
+        # An inprocess stage has no process to connect a pipe to
+        for name in self.job.inprocess:
+            if name in self.job.streamable:
+                exit_error("[pipeline] " + name + " can't be both inprocess "
+                           "and streamable")
+
+        # Consecutive stages that are streamable are joined with real pipes
+        # to the stage before them, when that is their only input. One group
+        # is a list of stage indexes.
+        self.groups = []
+        for idx, name in enumerate(self.stages):
+            if (self.groups and name in self.job.streamable and
+                    not name.endswith(".agg") and
+                    (self.stages[idx - 1] not in self.job.records or
+                     name in self.job.record_readers) and
+                    self.deps[idx] == [idx - 1] and
+                    self.inputs[idx] == idx - 1):
+                self.groups[-1].append(idx)
+            else:
+                self.groups.append([idx])
+
+        # group_deps[gidx] are the groups that have to finish before group gidx
+        group_of = {idx: gidx for gidx, group in enumerate(self.groups)
+                    for idx in group}
+        self.group_deps = [sorted({group_of[dep] for dep in
+                                   self.deps[group[0]]})
+                           for group in self.groups]
+
+    def add_metrics(self, env):
+        """Keep the metrics.json of the stage that just finished for the job
+        summary"""
+
+        path = env.pipedir + "/" + env.pipeidx + "/metrics.json"
+        if not os.path.exists(path):
+            return
+
+        with open(path) as metrics_fp:
+            metrics = json.load(metrics_fp)
+
+        metrics["checkout"] = env.checkout
+        metrics["stage"] = env.stage
+
+        with self.out_lock:
+            self.metrics.append(metrics)
+
+    def metrics_summary(self, name="metrics.json"):
+        """Save the totals per stage of the whole job, and the shell forks
+        avoided so far, to #PIPEDIR#/../name, and add it to git_out"""
+
+        keys = ["wall_time", "user_time", "sys_time", "read_bytes",
+                "write_bytes", "stdout_bytes", "stderr_bytes"]
+        stages = {}
+
+        for metrics in self.metrics:
+            if metrics["stage"] not in stages:
+                stages[metrics["stage"]] = dict.fromkeys(["runs", "cached",
+                                                          "failed", "max_rss"] +
+                                                         keys, 0)
+            total = stages[metrics["stage"]]
+
+            total["runs"] += 1
+            total["cached"] += int(metrics.get("cached", False))
+            total["failed"] += int(metrics["return_code"] != 0)
+            total["max_rss"] = max(total["max_rss"], metrics.get("max_rss", 0))
+            for key in keys:
+                total[key] += metrics.get(key, 0)
+
+        for stage, total in sorted(stages.items()):
+            logging.info("metrics: " + stage + ": " + str(total["runs"]) +
+                         " runs, " + str(round(total["wall_time"], 1)) +
+                         "s wall, " + str(round(total["user_time"] +
+                                                total["sys_time"], 1)) +
+                         "s cpu, " + str(total["max_rss"] >> 20) +
+                         "MB max rss")
+
+        # ExecTools.exit() is too late for a job of the daemon
+        logging.info("metrics: " + str(self.exe.forks_avoided) + " shell "
+                     "forks avoided by in-process file operations")
+
+        job_dir = (self.job.git_out.conf.repo_dir + "/" +
+                   self.job.conf.get("com", "name"))
+        if not os.path.isdir(job_dir):
+            return
+
+        summary = {"checkouts": len(set(x["checkout"] for x in self.metrics)),
+                   "forks_avoided": self.exe.forks_avoided, "stages": stages}
+        with open(job_dir + "/" + name, "w") as metrics_fp:
+            json.dump(summary, metrics_fp, indent=1, sort_keys=True)
+
+        with self.out_lock:
+            self.job.git_out.batcher.add(job_dir, [name], "metrics summary",
+                                         0)
+
+    def new_env(self, checkout, src_dir):
+        """Return a new Env for running the pipeline on checkout. src_dir is
+        the working tree where the stages will run"""
+
+        env = Env()
+        env.checkout = checkout
+        env.conf = self.job.conf
+        env.env_run = self.exe.run_stage
+        env.pipedir = (self.job.git_out.conf.repo_dir + "/" +
+                       self.job.conf.get("com", "name") + "/" + checkout)
+        env.src_dir = src_dir
+
+        return env
+
+    def checkout_run(self, checkout, src_dir, prev_env=None, touched=None):
+        """Run all stages of the pipeline for one checkout. On incremental
+        mode, prev_env is the Env of the previous commit and touched is the
+        list of files changed since it. Return the Env of checkout."""
+
+        env = self.new_env(checkout, src_dir)
+        if prev_env:
+            env.prev_pipedir = prev_env.pipedir
+            env.touched = touched
+
+        # Once here, and not on each copy of env
+        if self.cache or self.job.resume:
+            env.tree = self.exe.check_output(src_dir,
+                                             "git rev-parse HEAD^{tree}")
+
+        # A group starts as soon as the groups it depends on succeeded, so
+        # independent stages run at the same time. The groups depending on a
+        # failed one are skipped.
+        done = {}
+        running = {}
+        try:
+            with ThreadPoolExecutor(len(self.groups)) as pool:
+                while len(done) < len(self.groups):
+                    for gidx, group in enumerate(self.groups):
+                        if gidx in done or gidx in running.values():
+                            continue
+                        deps = self.group_deps[gidx]
+                        if any(dep in done and not done[dep] for dep in deps):
+                            done[gidx] = False
+                        elif all(done.get(dep) for dep in deps):
+                            running[pool.submit(self.group_run, env,
+                                                group)] = gidx
+
+                    if not running:
+                        continue
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        done[running.pop(future)] = future.result()
+        finally:
+            self.checkout_clean(env)
+
+        return env
+
+    def group_run(self, env, group):
+        """Run the stages of group, a list of stage indexes, on a copy of env
+        and add their results to git_out. Return True if all of them returned
+        0"""
+
+        env = copy.copy(env)
+
+        idx = self.inputs[group[0]]
+        if idx is not None:
+            env.pipestdout = (env.pipedir + "/" + str(idx) + "/" +
+                              self.exe.stdout_name)
+            env.pipestderr = env.pipedir + "/" + str(idx) + "/stderr"
+
+            if (self.stages[idx] in self.job.records and
+                    self.stages[group[0]] not in self.job.record_readers):
+                env.pipestdout = self.records_text(env.pipestdout)
+
+        if (self.job.resume and all(self.isdone(env, idx) for idx in group)
+                and self.readers_done(env, group)):
+            for idx in group:
+                env.pipeidx = str(idx)
+                env.stage = self.stages[idx]
+                logging.info("journal: " + env.stage + " is done for " +
+                             env.checkout + ", skipping it")
+                self.add_metrics(env)
+                if (self.index and
+                        not self.index.isindexed(env.checkout, env.stage)):
+                    self.index_add(env)
+                if env.stage in self.job.lookups:
+                    self.lookup_build(env)
+            return True
+
+        if len(group) == 1:
+            ret_list = self.stage_run(env, group[0])
+        else:
+            ret_list = self.stream_run(env, group)
+
+        for idx in group:
+            self.restored.pop(env.pipedir + "/" + str(idx) + "/" +
+                              self.exe.stdout_name, None)
+
+        ok = True
+        for idx, ret in zip(group, ret_list):
+            env.stage = self.stages[idx]
+            env.pipeidx = str(idx)
+            env.return_code = ret
+
+            self.add_metrics(env)
+
+            if ret == 0 and env.stage in self.job.delta:
+                self.delta_write(env)
+
+            # The journal entry goes on the same commit as the results
+            if self.job.resume and ret == 0:
+                entry = (env.pipeidx + " " + self.stage_key(env, idx) + " " +
+                         env.stage + "\n")
+                with self.out_lock:
+                    with open(env.pipedir + "/journal", "a") as journal_fp:
+                        journal_fp.write(entry)
+
+            with self.out_lock:
+                self.job.git_out.add_commit_push(env)
+
+            if self.index and ret == 0:
+                self.index_add(env)
+
+            if env.stage in self.job.lookups and ret == 0:
+                self.lookup_build(env)
+
+            if env.return_code != 0:
+                log_warn("Error running " + env.stage + " for " +
+                         env.checkout)
+                ok = False
+
+        return ok
+
+    def text_dir(self, path):
+        """Return the directory under tmp_dir for the copies of the results
+        at path, on git_out, that are not committed. See checkout_clean()"""
+
+        return (self.exe.tmp_dir + "/text/" +
+                os.path.relpath(path, self.job.git_out.conf.repo_dir))
+
+    def checkout_clean(self, env):
+        """Remove what the stages of env leave that doesn't go to git_out:
+        the copies of records_text() and plain_input(), and stderr once
+        compressed"""
+
+        self.exe.rmtree(self.text_dir(env.pipedir))
+
+        if not self.job.git_out.conf.compress:
+            return
+        for idx in range(self.stage_count):
+            stderr = env.pipedir + "/" + str(idx) + "/stderr"
+            if os.path.exists(stderr + self.exe.codec.ext):
+                os.remove(stderr)
+
+    def records_text(self, path):
+        """Return the path of the stdout at path as text, for the stages that
+        don't read records. It is converted once, to stdout.txt under
+        text_dir(), and only if it has records."""
+
+        text_path = self.text_dir(os.path.dirname(path)) + "/stdout.txt"
+
+        with self.text_lock:
+            if (os.path.exists(text_path) and
+                    os.path.getmtime(text_path) >= os.path.getmtime(path)):
+                return text_path
+
+            in_fp, in_proc = self.exe.open_input(path)
+            try:
+                reader = RecordReader(in_fp)
+                if not reader.isrecords:
+                    return path
+
+                os.makedirs(os.path.dirname(text_path), exist_ok=True)
+                with open(text_path + ".tmp", "w") as text_fp:
+                    text_fp.writelines(reader.lines())
+            finally:
+                self.exe.close_input(in_fp, in_proc)
+            os.replace(text_path + ".tmp", text_path)
+
+        logging.info("records: " + path + " as text at " + text_path)
+
+        return text_path
+
+    def plain_input(self, path):
+        """Return the path of the stdout at path decompressed, for the commands
+        that xargs can run more than once, see ExecTools.xargs_cmd(): only the
+        first one would read a compressed stdout from /dev/stdin. It is
+        decompressed once, under text_dir() and without the extension."""
+
+        if not self.exe.codec or not path.endswith(self.exe.codec.ext):
+            return path
+
+        plain_path = (self.text_dir(os.path.dirname(path)) + "/" +
+                      os.path.basename(path)[:-len(self.exe.codec.ext)])
+
+        with self.text_lock:
+            if (os.path.exists(plain_path) and
+                    os.path.getmtime(plain_path) >= os.path.getmtime(path)):
+                return plain_path
+
+            os.makedirs(os.path.dirname(plain_path), exist_ok=True)
+            in_fp, in_proc = self.exe.open_input(path)
+            try:
+                with open(plain_path + ".tmp", "wb") as plain_fp:
+                    shutil.copyfileobj(in_fp, plain_fp, 1 << 20)
+            finally:
+                self.exe.close_input(in_fp, in_proc)
+            os.replace(plain_path + ".tmp", plain_path)
+
+        logging.info("xargs: " + path + " decompressed to " + plain_path)
+
+        return plain_path
+
+    def lookup_build(self, env):
+        """Write the first CSV field of each row of the stdout of env.stage as
+        a Lookup at #PIPEDIR#/#PIPEIDX#/lookup, unless it is up to date. It is
+        not committed, it is rebuilt from stdout when needed."""
+
+        stage_dir = env.pipedir + "/" + env.pipeidx
+        stdout = stage_dir + "/" + self.exe.stdout_name
+        path = stage_dir + "/lookup"
+
+        if (os.path.exists(path) and
+                os.path.getmtime(path) >= os.path.getmtime(stdout)):
+            return
+
+        Lookup.write(path, (line.rstrip("\n").split(",", 1)[0].encode()
+                            for line in self.exe.read_lines(stdout)
+                            if line.strip()))
+
+        logging.info("lookup: " + path)
+
+    def index_add(self, env):
+        """Add the stdout of env.stage to the index"""
+
+        self.index.add(env.checkout, env.stage,
+                       self.exe.read_lines(env.pipedir + "/" + env.pipeidx +
+                                           "/" + self.exe.stdout_name),
+                       self.job.file_columns.get(env.stage))
+
+    def index_run(self):
+        """Index the results of all checkouts already on git_out"""
+
+        if not self.index:
+            exit_error("[index] db is not set")
+
+        self.job.git_out.snapshot(self.exe.tmp_dir + "/git_out_snapshot")
+        try:
+            self.index_tree()
+        finally:
+            self.exe.rmtree(self.job.git_out.conf.repo_dir)
+
+    def index_tree(self):
+        """Index the results on the working tree of git_out, see index_run"""
+
+        job_dir = (self.job.git_out.conf.repo_dir + "/" +
+                   self.job.conf.get("com", "name"))
+
+        # #PIPEDIR# is job_dir/checkout, and checkout can have slashes
+        for path, _, names in os.walk(job_dir):
+            if "script" not in names or not (self.exe.stdout_name in names or
+                                             "stdout.delta" in names):
+                continue
+
+            env = self.new_env(os.path.relpath(os.path.dirname(path),
+                                               job_dir), "")
+            env.pipeidx = os.path.basename(path)
+            if (not env.pipeidx.isdigit() or
+                    int(env.pipeidx) >= self.stage_count):
+                continue
+            env.stage = self.stages[int(env.pipeidx)]
+
+            if (self.exe.stdout_name not in names and
+                    not self.restore(env.checkout, int(env.pipeidx))):
+                continue
+
+            self.index_add(env)
+
+    def query_run(self, column, value):
+        """Print checkout,stage,rows for each checkout and stage with rows for
+        value on the index. column is key or file"""
+
+        if not self.index:
+            exit_error("[index] db is not set")
+
+        for row in self.index.query(column, value):
+            print(",".join(str(x) for x in row))
+
+    def stage_key(self, env, idx, tree=True):
+        """Return the key of the result of stage idx on env, made of the git
+        tree of the checkout, the contents of the stage script, the
+        [cmd_line_args] of the stage and the contents of the stdout of its
+        input. Same key, same result. Without tree, the key is the same for
+        all checkouts, see BlobMemo."""
+
+        if tree and not env.tree:
+            env.tree = self.exe.check_output(env.src_dir,
+                                             "git rev-parse HEAD^{tree}")
+
+        # Paths on pipe_par change from one checkout to another, but what
+        # they point to is already part of the key. Only #PIPEIDX# counts.
+        name = self.stages[idx]
+        pipe_par = env.conf.get("cmd_line_args", name.split(".")[1],
+                                fallback="")
+        pipe_par = pipe_par.replace("#PIPEIDX#", str(idx))
+
+        sha = hashlib.sha256()
+        if tree:
+            sha.update(env.tree.encode())
+        sha.update(StageCache.file_hash(SCRIPT_DIR + name).encode())
+        sha.update(pipe_par.encode())
+        if self.inputs[idx] is not None:
+            stdout = (env.pipedir + "/" + str(self.inputs[idx]) + "/" +
+                      self.exe.stdout_name)
+            sha.update((self.restored.get(stdout) or
+                        StageCache.file_hash(stdout)).encode())
+
+        return sha.hexdigest()
+
+    def isdone(self, env, idx):
+        """Return True if the journal of env says that stage idx is done, and
+        its results are still valid. The journal is #PIPEDIR#/journal on
+        git_out, one line per stage done: index, key and name of the stage. It
+        is committed with the results of each stage, so it survives a job that
+        died, and [git_out] resume skips what it says"""
+
+        journal = env.pipedir + "/journal"
+        stdout = env.pipedir + "/" + str(idx) + "/" + self.exe.stdout_name
+        if not os.path.exists(journal):
+            return False
+        if not os.path.exists(stdout) and not self.restore(env.checkout, idx):
+            return False
+
+        entry = str(idx) + " " + self.stage_key(env, idx) + " "
+        with open(journal) as journal_fp:
+            return any(line.startswith(entry) for line in journal_fp)
+
+    def readers_done(self, env, group):
+        """Return True if the stages that read the outputs of group restored
+        from the deltas are done, and the ones that read theirs, and so on.
+        Restored rows are sorted, a stage that runs again needs the ones that
+        its input wrote, so then group has to run again too."""
+
+        stdout_name = "/" + self.exe.stdout_name
+        restored = {idx for idx in group if env.pipedir + "/" + str(idx) +
+                    stdout_name in self.restored}
+
+        for idx in range(group[-1] + 1, self.stage_count):
+            if not restored:
+                break
+            if self.inputs[idx] not in restored:
+                continue
+            if not self.isdone(env, idx):
+                return False
+            if env.pipedir + "/" + str(idx) + stdout_name in self.restored:
+                restored.add(idx)
+
+        return True
+
+    def checkout_isdone(self, checkout):
+        """Return True if all stages are done for checkout, see isdone(). No
+        checkout of git_in is needed to know it"""
+
+        if not self.job.resume:
+            return False
+
+        git_in_dir = self.job.git_in.conf.repo_dir
+        env = self.new_env(checkout, git_in_dir)
+        env.tree = self.exe.check_output(git_in_dir, "git rev-parse " +
+                                         checkout + "^{tree}")
+
+        if not all(self.isdone(env, idx) for idx in range(self.stage_count)):
+            return False
+
+        logging.info("journal: " + checkout + " is done, skipping it")
+        return True
+
+    def delta_chain(self, checkouts):
+        """Make each checkout on checkouts the reference of the one after it
+        for [git_out] delta. The first one is the baseline."""
+
+        for prev, checkout in zip(checkouts, checkouts[1:]):
+            self.delta_prev[checkout] = prev
+
+    def delta_write(self, env):
+        """Save the rows added to and removed from the stdout of env.stage
+        since the previous checkout as #PIPEDIR#/#PIPEIDX#/stdout.delta, that
+        goes to git_out instead of stdout. The first line is =, the previous
+        checkout, a space and the hash of stdout, see restore(). The others
+        are - or + and a row, sorted. Rows are a multiset,
+        a row that shows up twice more is added twice. Nothing is saved for
+        the baseline, or when the output of the previous checkout is not
+        available or it failed, and then stdout goes to git_out as usual."""
+
+        prev = self.delta_prev.get(env.checkout)
+        if not prev:
+            return
+
+        # The previous checkout can be running on another worktree
+        if prev in self.delta_done:
+            self.delta_done[prev].wait()
+
+        # Whatever it left on git_out can be half written
+        if prev in self.delta_failed:
+            log_warn("delta: " + prev + " failed, saving the whole output "
+                     "of " + env.stage + " for " + env.checkout)
+            return
+
+        old = self.reconstruct(prev, int(env.pipeidx))
+        if old is None:
+            log_warn("delta: no output of " + env.stage + " for " + prev +
+                     ", saving the whole output for " + env.checkout)
+            return
+
+        stdout = env.pipedir + "/" + env.pipeidx + "/" + self.exe.stdout_name
+        old = collections.Counter(old)
+        new = collections.Counter(self.delta_rows(stdout))
+
+        with open(os.path.dirname(stdout) + "/stdout.delta", "w") as delta_fp:
+            delta_fp.write("=" + prev + " " + StageCache.file_hash(stdout) +
+                           "\n")
+            delta_fp.writelines("-" + row for row in
+                                sorted((old - new).elements()))
+            delta_fp.writelines("+" + row for row in
+                                sorted((new - old).elements()))
+
+    def delta_rows(self, path):
+        """Iterate over the rows of the stdout at path, all ending with a new
+        line"""
+
+        for line in self.exe.read_lines(path):
+            yield line if line.endswith("\n") else line + "\n"
+
+    def reconstruct(self, checkout, idx):
+        """Return the rows of the stdout of stage idx for checkout, sorted, or
+        None if git_out has neither the stdout nor a chain of deltas that ends
+        on one. See delta_write()"""
+
+        stage_path = "/" + str(idx) + "/"
+        chain = []
+        while True:
+            pipedir = self.new_env(checkout, "").pipedir
+            stdout = pipedir + stage_path + self.exe.stdout_name
+            if os.path.exists(stdout):
+                break
+
+            delta = pipedir + stage_path + "stdout.delta"
+            if not os.path.exists(delta) or delta in chain:
+                return None
+            chain.append(delta)
+
+            with open(delta) as delta_fp:
+                checkout = delta_fp.readline()[1:].split()[0]
+
+        rows = collections.Counter(self.delta_rows(stdout))
+        for delta in reversed(chain):
+            with open(delta) as delta_fp:
+                next(delta_fp)
+                for line in delta_fp:
+                    rows[line[1:]] += 1 if line[0] == "+" else -1
+
+        return sorted(rows.elements())
+
+    def restore(self, checkout, idx):
+        """Rebuild the stdout of stage idx for checkout from the deltas on
+        git_out. Return False if it can't be done. The rows are sorted, so
+        stage_key() takes the hash of the stdout that the stage wrote from the
+        delta, for the stages that read it."""
+
+        rows = self.reconstruct(checkout, idx)
+        if rows is None:
+            return False
+
+        stage_dir = self.new_env(checkout, "").pipedir + "/" + str(idx)
+        self.exe.write_lines(stage_dir, rows)
+
+        with open(stage_dir + "/stdout.delta") as delta_fp:
+            fields = delta_fp.readline().split()
+        if len(fields) > 1:
+            self.restored[stage_dir + "/" + self.exe.stdout_name] = fields[1]
+        return True
+
+    def reconstruct_run(self, checkout, stage):
+        """Print the output of stage for checkout, rebuilt from the deltas on
+        git_out if needed. stage is the name or the index of the stage."""
+
+        idx = int(stage) if stage.isdigit() else None
+        if idx is None and stage in self.stages:
+            idx = self.stages.index(stage)
+        if idx is None or idx >= self.stage_count:
+            exit_error(stage + " is not a stage")
+
+        # stdout is for the rows only
+        self.job.git_out.snapshot(self.exe.tmp_dir + "/git_out_snapshot")
+        try:
+            rows = self.reconstruct(checkout, idx)
+        finally:
+            self.exe.rmtree(self.job.git_out.conf.repo_dir)
+        if rows is None:
+            exit_error("No output of " + self.stages[idx] + " for " +
+                       checkout + " on git_out")
+
+        print("".join(rows), end="")
+
+    def stage_run(self, env, idx):
+        """Run the stage idx on its own. Return a list with its $?"""
+
+        stage = Stage(self.stages[idx])
+        stage.set_env(env)
+
+        env.stage = stage.name
+        env.pipeidx = str(idx)
+
+        self.job.git_out.prepare(env)
+
+        if not self.cache:
+            return [self.stage_exec(env, stage)]
+
+        stage_dir = env.pipedir + "/" + env.pipeidx
+        key = self.stage_key(env, idx)
+        if self.cache.get(key, stage_dir):
+            self.exe.write_metrics(stage_dir, 0, 0, None)
+            return [0]
+
+        ret = self.stage_exec(env, stage)
+        if ret == 0:
+            self.cache.put(key, stage_dir)
+
+        return [ret]
+
+    def stage_exec(self, env, stage):
+        """Execute stage, incrementally or sharded if possible, once there is
+        memory for it, see MemoryBudget. Return $?"""
+
+        # .agg and inprocess stages don't start processes
+        if (not self.memory or stage.name.endswith(".agg") or
+                stage.name in self.job.inprocess):
+            return self.stage_dispatch(env, stage)
+
+        processes = 1
+        if self.shard_costs and (stage.name.endswith(".cocci") or
+                                 stage.name in self.job.blob_stages):
+            processes = self.job.shards
+
+        # spatch -j of [cmd_line_args], fewer if the budget says so
+        jobs = 0
+        if stage.name.endswith(".cocci"):
+            found = re.findall(r"(?:-j|--jobs)\s*(\d+)",
+                               env.conf.get("cmd_line_args", "cocci",
+                                            fallback=""))
+            jobs = int(found[-1]) if found else 0
+
+        granted, reserved = self.memory.admit([stage.name], processes, jobs)
+        if granted != jobs:
+            stage.jobs = granted
+
+        start = time.time()
+        try:
+            ret = self.stage_dispatch(env, stage)
+        finally:
+            self.memory.release(reserved)
+
+        if ret == 0:
+            self.memory_update(env.pipedir + "/" + env.pipeidx, stage.name,
+                               start, processes)
+
+        return ret
+
+    def memory_update(self, stage_dir, name, start, processes=1):
+        """Teach self.memory the peak RSS of stage name from the metrics.json
+        at stage_dir, if written after start"""
+
+        path = stage_dir + "/metrics.json"
+        if not os.path.exists(path) or os.path.getmtime(path) < start:
+            return
+
+        with open(path) as metrics_fp:
+            max_rss = json.load(metrics_fp).get("max_rss", 0)
+        if not max_rss:
+            return
+
+        # The process of the stage is a fork of popype, its RSS before the
+        # exec counts. A stage that never used more is as good as nothing.
+        if max_rss <= resource.getrusage(resource.RUSAGE_SELF).ru_maxrss << 10:
+            max_rss = 0
+        self.memory.update(name, max_rss, processes)
+
+    def stage_dispatch(self, env, stage):
+        """Execute stage, incrementally or sharded if possible. Return $?"""
+
+        if stage.name.endswith(".agg"):
+            return self.aggregate_run(env, stage)
+
+        if self.blobs and stage.name in self.job.blob_stages:
+            return self.blob_run(env, stage)
+
+        if self.isincremental(env, stage):
+            return self.incremental_run(env, stage)
+
+        if self.shard_costs and stage.name.endswith(".cocci"):
+            return self.shard_run(env, stage)
+
+        if stage.name in self.job.inprocess:
+            return self.inprocess_run(env, stage)
+
+        return stage.run()
+
+    def aggregate_run(self, env, stage):
+        """Run a .agg stage on this process, see Aggregate. Return $?"""
+
+        stage_dir = env.pipedir + "/" + env.pipeidx
+        log_str = ("cd " + env.src_dir + "; aggregate " + SCRIPT_DIR +
+                   stage.name + " < " + (env.pipestdout or "/dev/null") +
+                   " 2> " + stage_dir + "/stderr > " + stage_dir + "/" +
+                   self.exe.stdout_name)
+
+        start = time.time()
+        before = resource.getrusage(resource.RUSAGE_THREAD)
+
+        lines = []
+        err = ""
+        try:
+            conf = ConfigParser()
+            conf.read(SCRIPT_DIR + stage.name)
+            aggregate = Aggregate(conf["aggregate"])
+
+            if env.pipestdout:
+                in_fp, in_proc = self.exe.open_input(env.pipestdout)
+                try:
+                    lines = aggregate.run(in_fp)
+                finally:
+                    self.exe.close_input(in_fp, in_proc)
+            ret = 0
+        except (KeyError, ValueError, re.error,
+                subprocess.CalledProcessError) as error:
+            err = stage.name + ": " + str(error) + "\n"
+            ret = 1
+
+        out_fp, out_proc = self.exe.open_output(stage_dir)
+        out_fp.writelines(lines)
+        ret = self.exe.close_output(out_fp, out_proc) or ret
+        self.exe.create_file(err, stage_dir + "/stderr")
+
+        after = resource.getrusage(resource.RUSAGE_THREAD)
+        rusage = types.SimpleNamespace(
+            **{field: getattr(after, field) - getattr(before, field)
+               for field in ["ru_utime", "ru_stime", "ru_inblock",
+                             "ru_oublock"]})
+        rusage.ru_maxrss = after.ru_maxrss
+        self.exe.write_metrics(stage_dir, ret, time.time() - start, rusage)
+
+        if ret:
+            log_str += " ($? = " + str(ret) + ")"
+        logging.info(log_str)
+
+        return ret
+
+    def inprocess_run(self, env, stage):
+        """Run a .py stage listed at [pipeline] inprocess by calling its
+        popype_stage() on a worker process, see inprocess_stage(). Workers are
+        reused from one stage to the next, so there is no shell, no new
+        interpreter and no import for each checkout, and a stage that crashes
+        its worker only fails itself. Return $?"""
+
+        stage_dir = env.pipedir + "/" + env.pipeidx
+        args = {"checkout": env.checkout, "pipedir": env.pipedir,
+                "pipeidx": env.pipeidx, "pipestderr": env.pipestderr,
+                "pipestdout": env.pipestdout, "src_dir": env.src_dir}
+
+        with self.py_lock:
+            if not self.py_pool:
+                self.py_pool = ProcessPoolExecutor(
+                    self.job.py_workers,
+                    mp_context=multiprocessing.get_context("forkserver"))
+            pool = self.py_pool
+
+        start = time.time()
+        try:
+            ret, rusage = pool.submit(inprocess_stage, SCRIPT_DIR + stage.name,
+                                      stage_dir, args, self.exe.codec).result()
+        except BrokenProcessPool:
+            # The next stages get a new pool
+            with self.py_lock:
+                if self.py_pool is pool:
+                    self.py_pool = None
+            self.exe.create_file(stage.name + ": worker process died\n",
+                                 stage_dir + "/stderr")
+            ret = -signal.SIGKILL
+            rusage = types.SimpleNamespace(ru_utime=0, ru_stime=0, ru_maxrss=0,
+                                           ru_inblock=0, ru_oublock=0)
+            if not os.path.exists(stage_dir + "/" + self.exe.stdout_name):
+                self.exe.write_lines(stage_dir, [])
+
+        self.exe.write_metrics(stage_dir, ret, time.time() - start, rusage)
+
+        log_str = ("cd " + env.src_dir + "; popype_stage() of " + SCRIPT_DIR +
+                   stage.name + " < " + (env.pipestdout or "/dev/null") +
+                   " 2> " + stage_dir + "/stderr > " + stage_dir + "/" +
+                   self.exe.stdout_name)
+        if ret:
+            log_str += " ($? = " + str(ret) + ")"
+        logging.info(log_str)
+
+        return ret
+
+    def blob_run(self, env, stage):
+        """Run stage only on the files of the checkout whose git blob is not
+        on self.blobs for the stage, save the rows of each new blob there, and
+        write the rows of every file as the stdout of the stage, with the path
+        of the file on this checkout. The files are the ones matching
+        [pipeline] shard_files. Rows for files that were not given to the
+        stage are kept, but only for this checkout. Return $?"""
+
+        column = self.job.file_columns[stage.name]
+        stage_dir = env.pipedir + "/" + env.pipeidx
+        key = self.stage_key(env, int(env.pipeidx), tree=False)
+
+        # mode blob stage<TAB>path
+        blob_of = {}
+        for entry in self.exe.check_output(env.src_dir, "git ls-files -s -z "
+                                           "-- " + self.job.shard_files
+                                           ).split("\0"):
+            if entry:
+                info, path = entry.split("\t", 1)
+                blob_of[path] = info.split()[1]
+
+        known = self.blobs.get(key, set(blob_of.values()))
+
+        # One path for each new blob, even if it is on many paths
+        path_of = {}
+        for path, blob in sorted(blob_of.items()):
+            if blob not in known:
+                path_of.setdefault(blob, path)
+        files = sorted(path_of.values())
+
+        # xargs can run the stage more than once, see ExecTools.xargs_cmd()
+        run_env = copy.copy(env)
+        if files:
+            run_env.pipestdout = self.plain_input(env.pipestdout)
+            stage.set_env(run_env)
+
+        ret = 0
+        if files and self.shard_costs:
+            pairs = self.shard_costs.estimate(stage.name, env.src_dir, files)
+            ret, times = self.exe.run_shards(
+                run_env, stage.command(), ShardCosts.partition(
+                    pairs, self.job.shards), self.job.shard_resplit)
+            if ret == 0:
+                self.shard_costs.update(stage.name, times)
+        elif files:
+            list_path = stage_dir + "/files"
+            self.exe.create_file("".join("./" + x + "\n" for x in files),
+                                 list_path)
+            ret = env.env_run(run_env, self.exe.xargs_cmd(list_path,
+                                                          stage.command()))
+            os.remove(list_path)
+        else:
+            self.exe.create_file("", stage_dir + "/stderr")
+
+        if ret != 0:
+            return ret
+
+        # The path on each row becomes a \0, and the rows of a blob are saved
+        # as a single string
+        new_rows = {blob: [] for blob in path_of}
+        blob_at = {path: blob for blob, path in path_of.items()}
+        others = []
+        if files:
+            for row in self.exe.read_lines(stage_dir + "/" +
+                                           self.exe.stdout_name):
+                fields = row.rstrip("\n").split(",")
+                path = fields[column] if len(fields) > column else ""
+                if path.startswith("./"):
+                    path = path[2:]
+                if path not in blob_at:
+                    others.append(",".join(fields) + "\n")
+                    continue
+                fields[column] = fields[column].replace(path, "\0", 1)
+                new_rows[blob_at[path]].append(",".join(fields) + "\n")
+
+        new_rows = {blob: "".join(rows) for blob, rows in new_rows.items()}
+        self.blobs.put(key, new_rows)
+        known.update(new_rows)
+
+        def rows():
+            for path, blob in sorted(blob_of.items()):
+                for row in known[blob].splitlines(keepends=True):
+                    yield row.replace("\0", path)
+            yield from others
+
+        self.exe.write_lines(stage_dir, rows())
+
+        logging.info("blobs " + stage.name + " on " + env.checkout + ": " +
+                     str(len(blob_of)) + " files, " + str(len(files)) +
+                     " new blobs")
+        if others:
+            log_warn(str(len(others)) + " rows of " + stage.name + " for " +
+                     env.checkout + " are not about the files analyzed")
+
+        return ret
+
+    def shard_run(self, env, stage):
+        """Run a .cocci stage as [pipeline] shards processes at the same time,
+        each one on consecutive files of the checkout, instead of a single
+        process on the whole tree. The files are split in shards of about the
+        same cost using the time each file took on previous runs, and the
+        stdout of the shards is joined in order. Return $?"""
+
+        files = self.exe.check_output(env.src_dir, "git ls-files -- " +
+                                      self.job.shard_files).split("\n")
+        files = [x for x in files if x]
+        if not files:
+            return stage.run()
+
+        pairs = self.shard_costs.estimate(stage.name, env.src_dir, files)
+        shards = ShardCosts.partition(pairs, self.job.shards)
+
+        env = copy.copy(env)
+        env.pipestdout = self.plain_input(env.pipestdout)
+        stage.set_env(env)
+
+        ret, times = self.exe.run_shards(env, stage.command(), shards,
+                                         self.job.shard_resplit)
+        if ret == 0:
+            self.shard_costs.update(stage.name, times)
+
+        return ret
+
+    def isincremental(self, env, stage):
+        """Return True if the results of stage for the previous commit of a
+        range can be updated with the touched files only"""
+
+        if env.touched is None or stage.name not in self.job.file_columns:
+            return False
+
+        prev_stage_dir = env.prev_pipedir + "/" + env.pipeidx
+        if not os.path.exists(prev_stage_dir + "/" + self.exe.stdout_name):
+            return False
+
+        # The stage also depends on its input, that must be the same. Not
+        # #PIPESTDOUT#, that can be a copy, see text_dir()
+        idx = self.inputs[int(env.pipeidx)]
+        if idx is not None:
+            path = "/" + str(idx) + "/" + self.exe.stdout_name
+            if (not os.path.exists(env.prev_pipedir + path) or
+                    not filecmp.cmp(env.pipedir + path,
+                                    env.prev_pipedir + path, shallow=False)):
+                return False
+
+        return True
+
+    def incremental_run(self, env, stage):
+        """Run stage only on the files touched since the previous commit, and
+        merge the results with the stdout of the previous commit: rows of
+        touched files are replaced by the new ones. The files are the touched
+        ones matching [pipeline] shard_files, given by xargs. Return $?"""
+
+        column = self.job.file_columns[stage.name]
+        stage_dir = env.pipedir + "/" + env.pipeidx
+        prev_stdout = (env.prev_pipedir + "/" + env.pipeidx + "/" +
+                       self.exe.stdout_name)
+
+        # Deleted files are touched, but there is nothing to analyze
+        touched = set(env.touched)
+        files = [x for x in self.exe.check_output(
+            env.src_dir, "git ls-files -z -- " + self.job.shard_files
+            ).split("\0") if x in touched]
+
+        if files:
+            list_path = stage_dir + "/files"
+            self.exe.create_file("".join("./" + x + "\n" for x in files),
+                                 list_path)
+            env = copy.copy(env)
+            env.pipestdout = self.plain_input(env.pipestdout)
+            stage.set_env(env)
+            ret = env.env_run(env, self.exe.xargs_cmd(list_path,
+                                                      stage.command()))
+            os.remove(list_path)
+        else:
+            self.exe.write_lines(stage_dir, [])
+            self.exe.create_file("", stage_dir + "/stderr")
+            ret = 0
+
+        if ret != 0:
+            return ret
+
+        new_rows = list(self.exe.read_lines(stage_dir + "/" +
+                                            self.exe.stdout_name))
+
+        def merged():
+            for row in self.exe.read_lines(prev_stdout):
+                fields = row.rstrip("\n").split(",")
+                if len(fields) > column:
+                    name = fields[column]
+                    if name.startswith("./"):
+                        name = name[2:]
+                    if name in touched:
+                        continue
+                yield row
+
+            for row in new_rows:
+                yield row
+
+        self.exe.write_lines(stage_dir, merged())
+
+        logging.info("incremental " + stage.name + " on " + env.checkout +
+                     ": " + str(len(files)) + " files, " +
+                     str(len(new_rows)) + " new rows")
+
+        return ret
+
+    def stream_run(self, env, group):
+        """Run the stages on group at the same time, connecting stdout of one
+        stage to the stdin of the next with real pipes. stdout is still saved
+        to disk by a tee, but the next stage doesn't wait for it. Return the
+        list of $?"""
+
+        group_stdout = env.pipestdout
+        stage_list = []
+
+        for idx in group:
+            stage = Stage(self.stages[idx])
+            stage.set_env(env)
+
+            env.stage = stage.name
+            env.pipeidx = str(idx)
+
+            # The stdout of the previous stage is not on disk yet
+            if stage_list:
+                env.pipestdout = "/dev/stdin"
+
+            self.job.git_out.prepare(env)
+            stage_list.append((env.pipedir + "/" + env.pipeidx,
+                               stage.command()))
+
+            env.pipestderr = env.pipedir + "/" + env.pipeidx + "/stderr"
+
+        if not self.memory:
+            return self.exe.run_stream(env.src_dir, group_stdout, stage_list)
+
+        # All the stages of the group run at the same time
+        names = [self.stages[idx] for idx in group]
+        _, reserved = self.memory.admit(names)
+
+        start = time.time()
+        try:
+            ret_list = self.exe.run_stream(env.src_dir, group_stdout,
+                                           stage_list)
+        finally:
+            self.memory.release(reserved)
+
+        for name, (stage_dir, _), ret in zip(names, stage_list, ret_list):
+            if ret == 0:
+                self.memory_update(stage_dir, name, start)
+
+        return ret_list
+
+    def worktree_path(self, checkout):
+        """Return the path of the git worktree of checkout"""
+
+        return self.job.worktree_dir + "/" + checkout.replace("/", "_")
+
+    def worktree_run(self, checkout):
+        """Run the pipeline for checkout on its own git worktree"""
+
+        path = self.worktree_path(checkout)
+
+        # The next checkout waits for this one on delta_write(), whatever
+        # happens
+        finished = False
+        try:
+            with self.out_lock:
+                # Creating worktrees changes git_in/.git, do one at a time
+                self.job.git_in.worktree_add(path, checkout)
+
+            try:
+                self.checkout_run(checkout, path)
+                finished = True
+            finally:
+                with self.out_lock:
+                    self.job.git_in.worktree_remove(path)
+        finally:
+            if checkout in self.delta_done:
+                if not finished:
+                    self.delta_failed.add(checkout)
+                self.delta_done[checkout].set()
+
+    def prefetch(self, checkout):
+        """Create the git worktree of checkout, and ask the kernel to read
+        ahead the files matching [git_in] prefetch_files. Return its path."""
+
+        path = self.worktree_path(checkout)
+
+        with self.out_lock:
+            self.job.git_in.worktree_add(path, checkout)
+
+        files = self.exe.check_output(path, "git ls-files -z -- " +
+                                      self.job.prefetch_files).split("\0")
+        for name in filter(None, files):
+            try:
+                fd = os.open(path + "/" + name, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+        return path
+
+    def prefetch_run(self, checkouts):
+        """Run the pipeline for each checkout on checkouts, one at a time, on
+        git worktrees. The worktree of the next checkout is prepared by
+        prefetch() on the background while the pipeline runs for the current
+        one."""
+
+        if not checkouts:
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            future = prefetcher.submit(self.prefetch, checkouts[0])
+            for idx, checkout in enumerate(checkouts):
+                start = time.time()
+                path = future.result()
+                logging.info("prefetch: waited " +
+                             str(round(time.time() - start, 1)) + "s for " +
+                             checkout)
+
+                if idx + 1 < len(checkouts):
+                    future = prefetcher.submit(self.prefetch,
+                                               checkouts[idx + 1])
+
+                try:
+                    self.checkout_run(checkout, path)
+                finally:
+                    with self.out_lock:
+                        self.job.git_in.worktree_remove(path)
+
+    def lease_run(self, queue, worker):
+        """Lease checkouts from queue and run the pipeline for them until the
+        queue is empty"""
+
+        while True:
+            checkout = queue.lease(worker)
+            if not checkout:
+                return
+
+            # The journal can be from a commit of this worker not pushed yet
+            if self.checkout_isdone(checkout):
+                self.job.git_out.batcher.on_pushed(
+                    lambda checkout=checkout: queue.done(checkout, worker))
+                continue
+
+            # Renew the lease while the pipeline runs
+            stop = threading.Event()
+            def heartbeat():
+                while not stop.wait(queue.lease_time / 3):
+                    queue.renew(checkout, worker)
+            renewer = threading.Thread(target=heartbeat, daemon=True)
+            renewer.start()
+
+            try:
+                if self.job.workers <= 1:
+                    self.job.git_in.reset_clean()
+                    self.job.git_in.git_checkout(checkout, iscritical=True)
+                    self.checkout_run(checkout, self.job.git_in.conf.repo_dir)
+                else:
+                    self.worktree_run(checkout)
+            except BaseException:
+                stop.set()
+                raise
+
+            # The results are only added to the batcher. Until they are
+            # pushed, the lease is renewed, and a worker that dies loses it.
+            def pushed(checkout=checkout, stop=stop):
+                stop.set()
+                queue.done(checkout, worker)
+            self.job.git_out.batcher.on_pushed(pushed)
+
+    def coordinator_run(self):
+        """Add the checkout targets of git_in to the queue, and wait until the
+        workers are done"""
+
+        queue = TaskQueue(self.job.queue_db, self.job.queue_lease)
+        queue.add(self.job.git_in.checkout_targets)
+
+        while True:
+            status = queue.status()
+            logging.info("queue: " + ", ".join(state + " " + str(count)
+                                               for state, count in
+                                               sorted(status.items())))
+            if set(status.keys()) <= set(["done"]):
+                return
+
+            time.sleep(60)
+
+    def worker_run(self):
+        """Run the pipeline for the checkouts leased from the queue. There is
+        one worker per thread, and there are [git_in] workers threads"""
+
+        self.job.git_in.init()
+        self.job.git_out.init()
+
+        queue = TaskQueue(self.job.queue_db, self.job.queue_lease)
+        worker = socket.gethostname() + ":" + str(os.getpid())
+
+        with ThreadPoolExecutor(max_workers=self.job.workers) as pool:
+            for future in [pool.submit(self.lease_run, queue,
+                                       worker + ":" + str(idx))
+                           for idx in range(self.job.workers)]:
+                future.result()
+
+        # Each server only knows its own checkouts, and one file for all of
+        # them would conflict on every push
+        self.metrics_summary("metrics." + socket.gethostname() + "." +
+                             str(os.getpid()) + ".json")
+
+        if self.py_pool:
+            self.py_pool.shutdown()
+
+        if self.cache:
+            self.cache.log_stats()
+
+        if self.blobs:
+            self.blobs.log_stats()
+
+    def checkouts_run(self):
+        """Run the pipeline for each checkout target of git_in"""
+
+        if self.job.delta:
+            self.delta_chain(self.job.git_in.checkout_targets)
+
+        # Done before, by a job that died. No need to checkout them.
+        self.job.git_in.checkout_targets = [
+            x for x in self.job.git_in.checkout_targets
+            if not self.checkout_isdone(x)]
+
+        if self.job.workers <= 1 and self.job.prefetch:
+            checkouts = self.job.git_in.checkout_targets
+            self.job.git_in.checkout_targets = []
+            self.prefetch_run(checkouts)
+            return
+
+        if self.job.workers <= 1:
+            for checkout in self.job.git_in:
+                self.checkout_run(checkout, self.job.git_in.conf.repo_dir)
+            return
+
+        # Parallel mode: one git worktree per checkout, and up to workers
+        # pipelines running at the same time
+        checkouts = self.job.git_in.checkout_targets
+        self.job.git_in.checkout_targets = []
+
+        # See delta_write()
+        for checkout in checkouts:
+            self.delta_done[checkout] = threading.Event()
+
+        with ThreadPoolExecutor(max_workers=self.job.workers) as pool:
+            for future in [pool.submit(self.worktree_run, checkout)
+                           for checkout in checkouts]:
+                future.result()
+
+    def range_run(self, commit_range):
+        """Run the pipeline on each commit of commit_range, base..tip. The
+        whole pipeline runs on base, but for the other commits the stages at
+        [pipeline] file_column only analyze the files changed by the commit"""
+
+        git_in = self.job.git_in
+        base = commit_range.split("..")[0].strip()
+        commits = git_in.rev_list("--reverse " + commit_range.strip())
+        if self.job.delta:
+            self.delta_chain([base] + commits)
+
+        if self.checkout_isdone(base):
+            env = self.new_env(base, git_in.conf.repo_dir)
+        else:
+            git_in.reset_clean()
+            git_in.git_checkout(base, iscritical=True)
+            env = self.checkout_run(base, git_in.conf.repo_dir)
+        prev = base
+
+        for commit in commits:
+            # The results of a commit done before are as good as new
+            if self.checkout_isdone(commit):
+                env = self.new_env(commit, git_in.conf.repo_dir)
+                prev = commit
+                continue
+
+            touched = git_in.diff_names(prev, commit)
+
+            git_in.reset_clean()
+            git_in.git_checkout(commit, iscritical=True)
+            env = self.checkout_run(commit, git_in.conf.repo_dir, env, touched)
+            prev = commit
+
+    def pipeline_run(self, init_git_in=True):
+        """The main loop of the pipeline. init_git_in is False when git_in is
+        ready to use, see Daemon"""
+
+        if init_git_in:
+            self.job.git_in.init()
+        self.job.git_out.init()
+
+        if self.job.reorder_window:
+            self.job.git_in.reorder_checkouts(self.job.reorder_window)
+
+        self.checkouts_run()
+
+        for commit_range in self.job.ranges:
+            self.range_run(commit_range)
+
+        self.metrics_summary()
+
+        if self.py_pool:
+            self.py_pool.shutdown()
+
+        if self.cache:
+            self.cache.log_stats()
+
+        if self.blobs:
+            self.blobs.log_stats()
+
+class Daemon:
+    """Keep popype running between jobs, with git_in ready to use. Jobs are
+    sent by popype.py --submit job_conf over a Unix socket, and run one at a
+    time. git_in is initialized as on a normal start only when the job uses
+    another config_url, when it needs refs that are not there, or when the last
+    fetch is older than [daemon] refresh seconds. Otherwise the job starts
+    right away, reusing the checked out tree and the fetched objects."""
+
+    def __init__(self):
+        conf = ConfigParser(interpolation=ExtendedInterpolation())
+        conf.read(CSP_CONF)
+
+        self.config_url = ""
+        self.fetch_time = 0
+        self.refresh = conf.getint("daemon", "refresh", fallback=300)
+
+    def git_in_init(self, git_in):
+        """Init git_in, unless it is still warm from the previous job"""
+
+        if (git_in.conf.config_url == self.config_url and
+                time.time() - self.fetch_time < self.refresh and
+                git_in.has_refs()):
+            logging.info("git_in is warm, skipping its init")
+            return
+
+        # If init does not finish, the next job has to do it again
+        self.config_url = ""
+        git_in.init()
+        self.config_url = git_in.conf.config_url
+        self.fetch_time = time.time()
+
+    def job_run(self, job_conf):
+        """Run the job described at job_conf. Return the reply for the
+        client"""
+
+        start = time.time()
+        mypipeline = None
+        ret = 0
+
+        # Errors call exit(), that should end the job and not the daemon, and
+        # the same goes for a bug hit by one job
+        try:
+            try:
+                mypipeline = Pipeline(job_conf)
+                self.git_in_init(mypipeline.job.git_in)
+                mypipeline.pipeline_run(init_git_in=False)
+            finally:
+                if mypipeline:
+                    mypipeline.job.git_out.batcher.flush()
+        except SystemExit as error:
+            ret = error.code or 1
+        except Exception:
+            logging.error(job_conf + ": job failed\n" + traceback.format_exc())
+            ret = 1
+
+        logging.info(job_conf + ": job finished in " +
+                     str(round(time.time() - start, 3)) + "s ($? = " +
+                     str(ret) + ")")
+
+        return {"job_conf": job_conf, "return_code": ret,
+                "wall_time": round(time.time() - start, 3)}
+
+    def serve(self):
+        """Wait for jobs forever"""
+
+        path = self.socket_path()
+        if os.path.exists(path):
+            os.remove(path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+
+        while True:
+            conn, _ = server.accept()
+            with conn, conn.makefile("rw") as conn_fp:
+                try:
+                    request = json.loads(conn_fp.readline())
+                    reply = self.job_run(request["job_conf"])
+                    conn_fp.write(json.dumps(reply) + "\n")
+                except (KeyError, OSError, ValueError) as error:
+                    logging.warning("Bad request: " + str(error))
+
+    @staticmethod
+    def socket_path():
+        """Path of the Unix socket, [daemon] socket at popype_conf"""
+
+        conf = ConfigParser(interpolation=ExtendedInterpolation())
+        conf.read(CSP_CONF)
+
+        if conf.has_option("daemon", "socket"):
+            return conf.get("daemon", "socket")
+
+        return conf.get("dir", "tmp_dir", fallback="/tmp") + "/popype.sock"
+
+    @staticmethod
+    def submit(job_conf):
+        """Send job_conf to the daemon and wait for the job to finish. Return
+        the $? of the job"""
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(Daemon.socket_path())
+
+        with client, client.makefile("rw") as client_fp:
+            client_fp.write(json.dumps({"job_conf":
+                                        os.path.abspath(job_conf)}) + "\n")
+            client_fp.flush()
+            reply = client_fp.readline()
+
+        if not reply:
+            print("The daemon did not reply")
+            return 1
+
+        reply = json.loads(reply)
+        print(job_conf + ": $? = " + str(reply["return_code"]) + " after " +
+              str(reply["wall_time"]) + "s")
+
+        return reply["return_code"]
 
 class JobConfig:
     """Store the instances related to the job described on the job_conf file"""
@@ -344,15 +3236,47 @@ class JobConfig:
         "\n"
         "    github.com/petersenna/popype/tree/master/Doc/job_example\n")
 
-    def __init__(self):
+    def __init__(self, exec_env, job_conf=JOB_CONF):
+        self.blob_db = ""
+        self.blob_stages = []
+        self.cache_dir = ""
+        self.cache_size = 0
         self.conf = None
+        self.delta = []
         self.env = None
+        self.exec_env = exec_env
+        self.file_columns = {}
         self.git_in = None
         self.git_out = None
+        self.index_db = ""
+        self.inprocess = []
+        self.job_conf = job_conf
+        self.lookups = []
+        self.memory_budget = 0
+        self.memory_peaks = ""
         self.pipeline_str = None
+        self.prefetch = False
+        self.prefetch_files = ""
+        self.py_workers = 1
+        self.queue_db = ""
+        self.record_readers = []
+        self.records = []
+        self.queue_lease = 0
+        self.ranges = []
+        self.reorder_window = 0
+        self.resume = False
+        self.shard_costs = ""
+        self.shard_files = ""
+        self.shard_resplit = 0
+        self.shards = 0
+        self.stage_inputs = {}
         self.stages_str = None
+        self.streamable = []
+        self.workers = 1
+        self.worktree_dir = ""
 
         self.read_config()
+        self.exec_env.setconf(self)
 
     def is_config_ok(self):
         """ Check if the configuration looks ok"""
@@ -376,51 +3300,229 @@ class JobConfig:
 
         return True
 
+    def get_list(self, section, option):
+        """Return the comma separated values of option on section, without
+        the empty ones. A missing option is an empty list"""
+
+        return [x.strip() for x in self.conf.get(section, option,
+                                                 fallback="").split(",")
+                if x.strip()]
+
     def read_config(self):
         """Read the job configuration file"""
 
         # Reading the configuration files
         self.conf = ConfigParser(interpolation=ExtendedInterpolation())
-        self.conf.read([CSP_CONF, JOB_CONF])
+        self.conf.read([CSP_CONF, self.job_conf])
 
         if not self.is_config_ok():
-            exit_error(JOB_CONF + " error")
+            exit_error(self.job_conf + " error")
 
         # [git_in]
-        self.git_in = GitRepo(self.conf.get("git_in", "config_url"),
+        self.git_in = GitRepo(self.exec_env,
+                              self.conf.get("git_in", "config_url"),
                               isconfig=True)
-        self.git_in.set_checkout(self.conf.get("git_in", "checkout"))
+        self.git_in.set_checkout(self.conf.get("git_in", "checkout",
+                                               fallback=""))
+        self.ranges = self.get_list("git_in", "range")
         self.git_in.conf.author_name = self.conf.get("com", "author")
         self.git_in.conf.author_email = self.conf.get("com", "email")
         self.git_in.conf.repo_dir = self.conf.get("dir", "git_in_dir")
 
+        # Fetch strategy, and an optional local mirror to borrow objects from
+        self.git_in.conf.fetch = [x for x in self.get_list("git_in", "fetch")
+                                  if x != "full"]
+        self.git_in.conf.reference = self.conf.get("git_in", "reference",
+                                                   fallback="")
+        self.git_in.conf.fetch_refs = list(self.git_in.checkout_targets)
+        for commit_range in self.ranges:
+            self.git_in.conf.fetch_refs += [x.strip() for x in
+                                            commit_range.split("..")]
+
+        # 0 keeps the order of [git_in] checkout
+        self.reorder_window = self.conf.getint("git_in", "reorder_window",
+                                               fallback=0)
+
+        # Prepare the next checkout on a worktree while the current one runs
+        self.prefetch = self.conf.getboolean("git_in", "prefetch",
+                                             fallback=False)
+        self.prefetch_files = " ".join("'" + x + "'" for x in
+                                       self.conf.get("git_in",
+                                                     "prefetch_files",
+                                                     fallback="").split())
+
+        # How many checkouts to process at the same time. Each one gets its
+        # own git worktree at worktree_dir
+        self.workers = self.conf.getint("git_in", "workers", fallback=1)
+        self.worktree_dir = self.conf.get("dir", "worktree_dir",
+                                          fallback=self.conf.get("dir",
+                                                                 "tmp_dir") +
+                                          "/worktrees")
+
         # [git_out]
-        self.git_out = GitRepo(self.conf.get("git_out", "repo_url"),
+        self.git_out = GitRepo(self.exec_env,
+                               self.conf.get("git_out", "repo_url"),
                                isrepo=True)
-        if self.conf.get("git_out", "compress") == "gz":
+        if self.conf.get("git_out", "compress") in Codec.exts:
             self.git_out.conf.compress = True
 
         self.git_out.conf.branch_for_write = self.conf.get("git_out", "branch")
         self.git_out.conf.ssl_key = self.conf.get("git_out", "key")
-        self.git_out.conf.ssl_key_path = self.conf.get("dir", "ssl_key_dir") +
-                                         "/id_rsa"
+        self.git_out.conf.ssl_key_path = (self.conf.get("dir", "ssl_key_dir") +
+                                          "/id_rsa")
         self.git_out.conf.author_name = self.conf.get("com", "author")
         self.git_out.conf.author_email = self.conf.get("com", "email")
         self.git_out.conf.repo_dir = self.conf.get("dir", "git_out_dir")
+        self.git_out.conf.fetch = [x for x in
+                                   self.get_list("git_out", "fetch")
+                                   if x != "full"]
+
+        # Results per commit, and when to commit anyway
+        self.git_out.conf.batch_count = self.conf.getint("git_out",
+                                                         "batch_count",
+                                                         fallback=1)
+        self.git_out.conf.batch_bytes = self.conf.getint("git_out", "batch_mb",
+                                                         fallback=0) << 20
+        self.git_out.conf.batch_seconds = self.conf.getint("git_out",
+                                                           "batch_seconds",
+                                                           fallback=0)
+        self.resume = self.conf.getboolean("git_out", "resume",
+                                           fallback=False)
+        self.delta = self.get_list("git_out", "delta")
 
         # [pipeline]
         self.pipeline_str = self.conf.get("pipeline", "pipeline")
+        self.streamable = self.get_list("pipeline", "streamable")
+
+        # stage:column, where column is the index of the file name on the CSV
+        # output of the stage
+        for item in self.get_list("pipeline", "file_column"):
+            name, column = item.rsplit(":", 1)
+            self.file_columns[name.strip()] = int(column)
+
+        # Stages that write their stdout with RecordWriter, and stages that
+        # read it with RecordReader instead of as text
+        self.records = self.get_list("pipeline", "records")
+        self.record_readers = self.get_list("pipeline", "record_readers")
+
+        # Stages whose keys are written as a Lookup file
+        self.lookups = self.get_list("pipeline", "lookup")
+
+        # .py stages run by popype_stage() on worker processes
+        self.inprocess = self.get_list("pipeline", "inprocess")
+        self.py_workers = self.conf.getint("pipeline", "py_workers",
+                                           fallback=os.cpu_count())
+
+        # stage: input + other + ..., where input is the stage whose stdout is
+        # read by stage, or none, and the others only have to finish first
+        for item in self.get_list("pipeline", "inputs"):
+            name, deps = item.split(":", 1)
+            self.stage_inputs[name.strip()] = [x.strip() or "none" for
+                                               x in deps.split("+")]
+
+        # .cocci stages split in shards, file patterns as for git ls-files
+        self.shards = self.conf.getint("pipeline", "shards", fallback=0)
+        self.shard_files = " ".join("'" + x + "'" for x in
+                                    self.conf.get("pipeline", "shard_files",
+                                                  fallback="*.c").split())
+        self.shard_resplit = self.conf.getfloat("pipeline", "shard_resplit",
+                                                fallback=2)
+        self.shard_costs = self.conf.get("pipeline", "shard_costs",
+                                         fallback=self.conf.get("dir",
+                                                                "tmp_dir") +
+                                         "/shard_costs.json")
+
+        # [queue] is only needed for --coordinator and --worker
+        self.queue_db = self.conf.get("queue", "db",
+                                      fallback=self.conf.get("dir", "tmp_dir") +
+                                      "/queue.sqlite")
+        self.queue_lease = self.conf.getint("queue", "lease", fallback=600)
+
+        # [index] is optional, no db no index
+        self.index_db = self.conf.get("index", "db", fallback="")
+
+        # [blobs] is optional, no db no memoization
+        self.blob_db = self.conf.get("blobs", "db", fallback="")
+        self.blob_stages = self.get_list("blobs", "stages")
+
+        # [memory] is optional, no budget no admission control
+        self.memory_budget = self.conf.getint("memory", "budget_mb",
+                                              fallback=0) << 20
+        self.memory_peaks = self.conf.get("memory", "peaks",
+                                          fallback=self.conf.get("dir",
+                                                                 "tmp_dir") +
+                                          "/memory_peaks.json")
+
+        # [cache] is optional, no dir no cache
+        self.cache_dir = self.conf.get("cache", "dir", fallback="")
+        self.cache_size = self.conf.getint("cache", "max_mb",
+                                           fallback=10240) << 20
+
+class Codec:
+    """Streaming compression of stage outputs. Compression and decompression
+    are done by external tools running as separate processes connected with
+    pipes, so they use other cores and nothing is decompressed to disk."""
+
+    exts = {"gz": ".gz", "xz": ".xz", "zstd": ".zst"}
+
+    def __init__(self, name, level=0, threads=0):
+        self.ext = self.exts[name]
+        self.name = name
+        self.threads = threads or os.cpu_count()
+
+        if name == "gz":
+            self.level = level or 6
+            # pigz is gzip using many cores, same output format
+            if shutil.which("pigz"):
+                self.compress_cmd = ("pigz -c -n -p " + str(self.threads) +
+                                     " -" + str(self.level))
+            else:
+                self.compress_cmd = "gzip -c -n -" + str(self.level)
+            self.decompress_cmd = "gzip -d -c"
+        elif name == "xz":
+            self.level = level or 6
+            self.compress_cmd = ("xz -c -T " + str(self.threads) + " -" +
+                                 str(self.level))
+            self.decompress_cmd = "xz -d -c -T " + str(self.threads)
+        else:
+            self.level = level or 3
+            self.compress_cmd = ("zstd -q -c -T" + str(self.threads) + " -" +
+                                 str(self.level))
+            self.decompress_cmd = "zstd -q -d -c"
+
+        for command in [self.compress_cmd, self.decompress_cmd]:
+            if not shutil.which(command.split()[0]):
+                exit_error(command.split()[0] + " not found, it is needed by "
+                           "compress: " + name)
+
+    def compressor(self, path):
+        """Return a process compressing its stdin to path"""
+
+        with open(path, "wb") as out_fp:
+            return subprocess.Popen(self.compress_cmd, shell=True,
+                                    stdin=subprocess.PIPE, stdout=out_fp)
+
+    def decompressor(self, path):
+        """Return a process decompressing path to its stdout"""
+
+        with open(path, "rb") as in_fp:
+            return subprocess.Popen(self.decompress_cmd, shell=True,
+                                    stdin=in_fp, stdout=subprocess.PIPE)
 
 class ExecTools:
     """Tools for execution"""
 
     def __init__(self):
+        self.codec = None
         self.env = None
         self.conf = None
         self.cwd = ""
         self.dl_dir = ""
+        self.forks_avoided = 0
+        self.lock = threading.Lock()
         self.log_file = ""
         self.pipeline_idx = 0
+        self.stdout_name = "stdout"
         self.tmp_dir = ""
 
         logging.basicConfig(format="(%(asctime)s %(levelname)s $ %(message)s)",
@@ -431,10 +3533,10 @@ class ExecTools:
 
         self.cwd = cwd
 
-        log_str = "cd " + self.cwd + "; " + str(command)
+        log_str = "cd " + cwd + "; " + str(command)
         logging.info(log_str)
 
-        stdout = subprocess.check_output(command, shell=True, cwd=self.cwd)
+        stdout = subprocess.check_output(command, shell=True, cwd=cwd)
         stdout = stdout.decode()
         stdout = stdout[:-1] # Remove the newline
 
@@ -450,8 +3552,10 @@ class ExecTools:
             tmp = "/tmp"
 
         chmod_cmd = "chmod " + opts
+        mode, path = opts.split(" ", 1)
 
-        self.run(tmp, chmod_cmd, iscritical)
+        self.__inproc(tmp, chmod_cmd, lambda: os.chmod(path, int(mode, 8)),
+                      iscritical)
 
     def copy(self, source, target, iscritical=False):
         "Call cp -f"
@@ -464,7 +3568,8 @@ class ExecTools:
 
         cp_cmd = "cp -f " + source + " " + target
 
-        self.run(tmp, cp_cmd, iscritical)
+        self.__inproc(tmp, cp_cmd, lambda: shutil.copy(source, target),
+                      iscritical)
 
     def create_file(self, string, path):
         """Equivalent of echo string > path"""
@@ -485,14 +3590,23 @@ class ExecTools:
 
 
         dl_cmd = "curl -f -s " + url + " > " + filename
+        path = self.dl_dir + "/" + filename
 
-        self.run(self.dl_dir, dl_cmd, iscritical)
+        def download():
+            with urllib.request.urlopen(url) as response, \
+                 open(path, "wb") as dl_fp:
+                shutil.copyfileobj(response, dl_fp)
 
-        return self.dl_dir + "/" + filename
+        self.__inproc(self.dl_dir, dl_cmd, download, iscritical)
+
+        return path
 
     def exit(self, msg, error=True):
         """Does everything needed before exiting such as saving the logs"""
 
+        logging.info(str(self.forks_avoided) + " shell forks avoided by "
+                     "in-process file operations")
+
         if error:
             logging.error(msg + ". Exiting...")
         else:
@@ -514,12 +3628,146 @@ class ExecTools:
         if path[0] != "/":
             self.exit(mkdir_cmd + " Error: relative path not accepted")
 
-        self.run(tmp, mkdir_cmd, iscritical)
+        self.__inproc(tmp, mkdir_cmd, lambda: os.makedirs(path, exist_ok=True),
+                      iscritical)
+
+    def compress(self, path, iscritical=False):
+        """Compress path to path + codec.ext keeping path. gz is done
+        in-process, the equivalent of gzip -k -f -n path"""
+
+        name = os.path.basename(path)
+
+        if self.codec.name != "gz":
+            self.run(os.path.dirname(path), self.codec.compress_cmd + " < " +
+                     name + " > " + name + self.codec.ext, iscritical)
+            return
+
+        def compress():
+            # No name and mtime=0, as with -n, so the same input gives the same
+            # .gz. Not the same bytes gzip itself writes: zlib compresses in
+            # its own way, and the header says the OS is unknown.
+            with open(path, "rb") as in_fp, \
+                 open(path + ".gz", "wb") as raw_fp, \
+                 gzip.GzipFile("", "wb", fileobj=raw_fp,
+                               compresslevel=self.codec.level,
+                               mtime=0) as out_fp:
+                shutil.copyfileobj(in_fp, out_fp, 1 << 20)
+
+        self.__inproc(os.path.dirname(path), "gzip -k -f -n " + name, compress,
+                      iscritical)
+
+    def input_log(self, path):
+        """Log string for reading stdin from path"""
+
+        if not path:
+            return ""
+
+        if self.codec and path.endswith(self.codec.ext):
+            return self.codec.decompress_cmd + " < " + path + " | "
+
+        return "< " + path + " "
+
+    def open_input(self, path):
+        """Return (fp, proc) for reading the stdout of a stage at path, where
+        fp can be the stdin of a process. If path is compressed, fp is a pipe
+        from the decompressor proc, otherwise proc is None"""
+
+        if not path:
+            return subprocess.DEVNULL, None
+
+        if self.codec and path.endswith(self.codec.ext):
+            proc = self.codec.decompressor(path)
+            return proc.stdout, proc
+
+        return open(path, "rb"), None
+
+    def open_output(self, stage_dir):
+        """Return (fp, proc) for writing the stdout of a stage at stage_dir.
+        With compression, fp is a pipe to the compressor proc, otherwise proc is
+        None. Use close_output() when done"""
+
+        path = stage_dir + "/" + self.stdout_name
+
+        if self.codec:
+            proc = self.codec.compressor(path)
+            return proc.stdin, proc
+
+        return open(path, "wb"), None
+
+    @staticmethod
+    def close_output(out_fp, out_proc):
+        """Close what open_output() returned, and wait for the compressor.
+        Return its $?, 0 without compression"""
+
+        out_fp.close()
+        if out_proc:
+            return out_proc.wait()
+
+        return 0
+
+    @staticmethod
+    def wait_input(in_proc):
+        """Wait for the decompressor open_input() returned, if any. Return its
+        $?. A reader can stop before the end of its input, so SIGPIPE is not an
+        error"""
+
+        if not in_proc:
+            return 0
+
+        ret = in_proc.wait()
+        if ret in [-signal.SIGPIPE, 128 + signal.SIGPIPE]:
+            return 0
+
+        return ret
+
+    def close_input(self, in_fp, in_proc):
+        """Close what open_input() returned, for the readers on popype. Raise
+        CalledProcessError if the decompressor failed"""
+
+        if in_fp != subprocess.DEVNULL:
+            in_fp.close()
+
+        ret = self.wait_input(in_proc)
+        if ret:
+            raise subprocess.CalledProcessError(ret,
+                                                self.codec.decompress_cmd)
+
+    def output_log(self, stage_dir):
+        """Log string for writing stdout to stage_dir"""
+
+        if self.codec:
+            return " | " + self.codec.compress_cmd + " > " + stage_dir + "/" + \
+                   self.stdout_name
+
+        return " > " + stage_dir + "/" + self.stdout_name
 
     def pipeline(self):
         """Run the commands on the pipeline for each git_in.checkin_target"""
         pass
 
+    def read_lines(self, path):
+        """Iterate over the lines of the stdout of a stage at path, compressed
+        or not"""
+
+        in_fp, in_proc = self.open_input(path)
+        try:
+            # Records are read as text, see RecordReader
+            yield from RecordReader(in_fp).lines()
+        finally:
+            self.close_input(in_fp, in_proc)
+
+    def write_lines(self, stage_dir, lines):
+        """Save lines as the stdout of the stage at stage_dir"""
+
+        out_fp, out_proc = self.open_output(stage_dir)
+        try:
+            for line in lines:
+                out_fp.write(line.encode())
+        finally:
+            ret = self.close_output(out_fp, out_proc)
+        if ret:
+            raise subprocess.CalledProcessError(ret, self.codec.compress_cmd)
+
     def rmtree(self, path, iscritical=False):
         """Remove a directory tree with rm -rf. Use with care!"""
 
@@ -534,7 +3782,13 @@ class ExecTools:
         if path[0] != "/":
             self.exit(rm_cmd + " Error: relative path not accepted")
 
-        self.run(tmp, rm_cmd, iscritical)
+        def remove():
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+        self.__inproc(tmp, rm_cmd, remove, iscritical)
 
     def run(self, cwd, command_list, iscritical=False):
         """Run the command_list and analyse the $? of each command. If
@@ -546,7 +3800,285 @@ class ExecTools:
         if isinstance(command_list, str):
             command_list = [command_list]
 
-        return self.__call(command_list, iscritical)
+        return self.__call(cwd, command_list, iscritical)
+
+    def run_stage(self, env, command):
+        """Run command, the command line of one stage, on env.src_dir. stdout
+        and stderr of the command are saved at #PIPEDIR#/#PIPEIDX#/ and the
+        stdout of the previous stage, if any, is the stdin of command. Return
+        $?"""
+
+        stage_dir = env.pipedir + "/" + env.pipeidx
+
+        log_str = "cd " + env.src_dir + "; "
+        log_str += self.input_log(env.pipestdout) + command
+        log_str += " 2> " + stage_dir + "/stderr" + self.output_log(stage_dir)
+
+        with open(stage_dir + "/stderr", "wb") as err_fp:
+            in_fp, in_proc = self.open_input(env.pipestdout)
+            out_fp, out_proc = self.open_output(stage_dir)
+
+            start = time.time()
+            proc = subprocess.Popen(command, shell=True, cwd=env.src_dir,
+                                    stdin=in_fp, stdout=out_fp,
+                                    stderr=err_fp)
+            if in_fp != subprocess.DEVNULL:
+                in_fp.close()
+
+            ret, rusage = self.wait(proc)
+            wall_time = time.time() - start
+
+            # The stage fails if its stdout was not compressed whole, or its
+            # stdin not decompressed whole
+            out_ret = self.close_output(out_fp, out_proc)
+            in_ret = self.wait_input(in_proc)
+            ret = ret or out_ret or in_ret
+
+        self.write_metrics(stage_dir, ret, wall_time, rusage)
+
+        if ret:
+            log_str += " ($? = " + str(ret) + ")"
+        logging.info(log_str)
+
+        return ret
+
+    def run_shards(self, env, command, shards, resplit):
+        """Run command on env.src_dir once per shard, all at the same time.
+        shards is a list of lists of (file, cost), and the files of each shard
+        are given to command as arguments by xargs, see xargs_cmd(). When a
+        single shard is still running after resplit times what its cost says it
+        should take, judging by the others, it is killed and its files are
+        split again among the idle slots. The stdout and stderr of the shards
+        are joined in order as the ones of the stage. Return $? and the list of
+        (shard, wall_time)"""
+
+        stage_dir = env.pipedir + "/" + env.pipeidx
+        shard_dir = stage_dir + "/shards"
+        self.rmtree(shard_dir)
+        self.makedirs(shard_dir, iscritical=True)
+
+        cond = threading.Condition()
+        killed = set()
+        names = []
+        pairs_of = {}
+        procs = {}
+        results = {}
+
+        def shard_exec(name):
+            list_path = shard_dir + "/" + name + ".files"
+            with open(list_path, "w") as list_fp:
+                list_fp.writelines("./" + path + "\n" for path, _ in
+                                   pairs_of[name])
+
+            shard_cmd = self.xargs_cmd(list_path, command)
+            log_str = ("cd " + env.src_dir + "; " +
+                       self.input_log(env.pipestdout) + shard_cmd + " > " +
+                       shard_dir + "/" + name + ".stdout 2> " + shard_dir +
+                       "/" + name + ".stderr")
+
+            with open(shard_dir + "/" + name + ".stdout", "wb") as out_fp, \
+                 open(shard_dir + "/" + name + ".stderr", "wb") as err_fp:
+                in_fp, in_proc = self.open_input(env.pipestdout)
+
+                start = time.time()
+                # Its own process group, to kill xargs and its children
+                proc = subprocess.Popen(shard_cmd, shell=True,
+                                        cwd=env.src_dir, stdin=in_fp,
+                                        stdout=out_fp, stderr=err_fp,
+                                        start_new_session=True)
+                if in_fp != subprocess.DEVNULL:
+                    in_fp.close()
+                with cond:
+                    procs[name] = (proc, start)
+
+                ret, rusage = self.wait(proc)
+                in_ret = self.wait_input(in_proc)
+                ret = ret or in_ret
+
+            if ret:
+                log_str += " ($? = " + str(ret) + ")"
+            logging.info(log_str)
+
+            return ret, time.time() - start, rusage
+
+        def shard_run(name):
+            # A shard that raises still gets a result, the wait below is for
+            # all of them
+            result = (1, 0.0, types.SimpleNamespace(
+                ru_utime=0.0, ru_stime=0.0, ru_maxrss=0, ru_inblock=0,
+                ru_oublock=0))
+            try:
+                result = shard_exec(name)
+            except Exception:
+                log_warn("Shard " + name + " of " + stage_dir + " failed:\n" +
+                         traceback.format_exc())
+            finally:
+                with cond:
+                    results[name] = result
+                    cond.notify()
+
+        def shard_start(name, pairs):
+            names.append(name)
+            pairs_of[name] = pairs
+            threading.Thread(target=shard_run, args=(name,)).start()
+
+        start = time.time()
+        for idx, pairs in enumerate(shards):
+            shard_start(str(idx), pairs)
+
+        with cond:
+            while len(results) < len(names):
+                cond.wait(1)
+
+                running = [x for x in names if x not in results]
+                if (not resplit or killed or len(names) < 2 or
+                        len(running) != 1 or running[0] not in procs or
+                        len(pairs_of[running[0]]) < 2):
+                    continue
+
+                # The time per unit of cost of the finished shards says how
+                # long this one should take
+                name = running[0]
+                proc, proc_start = procs[name]
+                rate = (sum(results[x][1] for x in results) /
+                        sum(cost for x in results for _, cost in pairs_of[x]))
+                expected = rate * sum(cost for _, cost in pairs_of[name])
+                if time.time() - proc_start < resplit * expected:
+                    continue
+
+                logging.info("Shard " + name + " of " + stage_dir + " is a "
+                             "straggler, splitting it in " + str(len(shards)))
+                killed.add(name)
+                os.killpg(proc.pid, signal.SIGKILL)
+                for idx, pairs in enumerate(ShardCosts.partition(
+                        pairs_of[name], len(shards))):
+                    shard_start(name + "." + str(idx), pairs)
+
+        # 1.10 comes after 1.9
+        kept = sorted((x for x in names if x not in killed),
+                      key=lambda x: [int(y) for y in x.split(".")])
+
+        out_fp, out_proc = self.open_output(stage_dir)
+        with open(stage_dir + "/stderr", "wb") as err_fp:
+            for name in kept:
+                for name_ext, fp in [(name + ".stdout", out_fp),
+                                     (name + ".stderr", err_fp)]:
+                    # Not there if the shard failed before starting
+                    if os.path.exists(shard_dir + "/" + name_ext):
+                        with open(shard_dir + "/" + name_ext, "rb") as in_fp:
+                            shutil.copyfileobj(in_fp, fp, 1 << 20)
+        out_ret = self.close_output(out_fp, out_proc)
+
+        self.rmtree(shard_dir)
+
+        ret = next((results[x][0] for x in kept if results[x][0]), out_ret)
+
+        # The shards run at the same time, so their peak memory adds up
+        rusage = types.SimpleNamespace(
+            **{field: sum(getattr(results[x][2], field) for x in names)
+               for field in ["ru_utime", "ru_stime", "ru_maxrss",
+                             "ru_inblock", "ru_oublock"]})
+        self.write_metrics(stage_dir, ret, time.time() - start, rusage)
+
+        return ret, [(pairs_of[x], results[x][1]) for x in kept]
+
+    @staticmethod
+    def xargs_cmd(list_path, command):
+        """Return the command line running command with the lines of the file
+        at list_path as arguments. xargs runs command as few times as the
+        command line limit of the system allows, once for all but the longest
+        lists. Each run reads the same input, so command must not read it from
+        /dev/stdin, see Pipeline.plain_input()"""
+
+        # -s is what ARG_MAX leaves after the environment
+        env_size = sum(len(x) + len(y) + 2 for x, y in os.environ.items())
+        size = os.sysconf("SC_ARG_MAX") - env_size - 4096
+
+        return ("xargs -d '\\n' -s " + str(size) + " -a " + list_path + " " +
+                command)
+
+    def run_stream(self, cwd, stdin_path, stage_list):
+        """Run the commands of stage_list at the same time on cwd, like a shell
+        pipe. stage_list is a list of (stage_dir, command). The first command
+        reads from stdin_path, if any, and each stdout is written to
+        stage_dir/stdout and to the stdin of the next command. Return the list
+        of $?"""
+
+        log_str = "cd " + cwd + "; " + self.input_log(stdin_path)
+        log_str += " | ".join(command + " 2> " + stage_dir + "/stderr | tee " +
+                              stage_dir + "/" + self.stdout_name
+                              for stage_dir, command in stage_list)
+        log_str += " > /dev/null"
+
+        stdin, in_proc = self.open_input(stdin_path)
+
+        err_list = []
+        out_list = []
+        proc_list = []
+        start_list = []
+        tee_list = []
+        tee_pool = ThreadPoolExecutor(max(len(stage_list) - 1, 1))
+
+        for stage_dir, command in stage_list:
+            out_fp, out_proc = self.open_output(stage_dir)
+            out_list.append((out_fp, out_proc))
+            err_fp = open(stage_dir + "/stderr", "wb")
+            err_list.append(err_fp)
+
+            if proc_list:
+                stdin = subprocess.PIPE
+
+            # Only the last stage writes straight to disk
+            if len(proc_list) == len(stage_list) - 1:
+                stdout = out_fp
+            else:
+                stdout = subprocess.PIPE
+
+            start_list.append(time.time())
+            proc = subprocess.Popen(command, shell=True, cwd=cwd, stdin=stdin,
+                                    stdout=stdout, stderr=err_fp)
+
+            if proc_list:
+                tee_list.append(tee_pool.submit(self.tee,
+                                                proc_list[-1].stdout,
+                                                out_list[-2][0], proc.stdin))
+            elif stdin != subprocess.DEVNULL:
+                stdin.close()
+
+            proc_list.append(proc)
+
+        ret_list = []
+        metrics_list = []
+        for proc, start in zip(proc_list, start_list):
+            ret, rusage = self.wait(proc)
+            ret_list.append(ret)
+            metrics_list.append((time.time() - start, rusage))
+
+        # A stage fails if its stdout was not saved or compressed whole, and
+        # the first one also if its stdin was not decompressed whole
+        for idx, tee in enumerate(tee_list):
+            error = tee.result()
+            if error:
+                log_warn(stage_list[idx][0] + ": saving stdout: " + str(error))
+                ret_list[idx] = ret_list[idx] or 1
+        tee_pool.shutdown()
+        for idx, (out_fp, out_proc) in enumerate(out_list):
+            out_ret = self.close_output(out_fp, out_proc)
+            ret_list[idx] = ret_list[idx] or out_ret
+        for err_fp in err_list:
+            err_fp.close()
+        in_ret = self.wait_input(in_proc)
+        ret_list[0] = ret_list[0] or in_ret
+
+        for (stage_dir, _), ret, metrics in zip(stage_list, ret_list,
+                                                metrics_list):
+            self.write_metrics(stage_dir, ret, *metrics)
+
+        if any(ret_list):
+            log_str += " ($? = " + ",".join(str(x) for x in ret_list) + ")"
+        logging.info(log_str)
+
+        return ret_list
 
     def setconf(self, conf):
         "set self.conf and do some initializations"
@@ -556,6 +4088,18 @@ class ExecTools:
         self.log_file = self.conf.conf.get("dir", "log_file")
         self.tmp_dir = self.conf.conf.get("dir", "tmp_dir")
 
+        # Stage outputs are compressed while being written
+        compress = self.conf.conf.get("git_out", "compress", fallback="no")
+        if compress in Codec.exts:
+            self.codec = Codec(compress,
+                               self.conf.conf.getint("git_out",
+                                                     "compress_level",
+                                                     fallback=0),
+                               self.conf.conf.getint("git_out",
+                                                     "compress_threads",
+                                                     fallback=0))
+            self.stdout_name = "stdout" + self.codec.ext
+
         logging.basicConfig(filename=self.log_file)
 
     def ssh_handshake(self, url):
@@ -579,15 +4123,119 @@ class ExecTools:
 
         self.run(tmp, ssh_cmd, iscritical)
 
-    def __call(self, command_list, iscritical=False):
+    @staticmethod
+    def tee(source, out_fp, pipe):
+        """Copy everything from source to out_fp and pipe, until the end of
+        source, then close source and pipe. If the process reading from pipe
+        dies, keep saving to out_fp anyway, and if out_fp fails, keep feeding
+        pipe, so no process waits forever. Return the error of out_fp, if
+        any."""
+
+        error = None
+        try:
+            while True:
+                chunk = source.read1(65536)
+                if not chunk:
+                    break
+
+                if not error:
+                    try:
+                        out_fp.write(chunk)
+                    except OSError as out_error:
+                        error = out_error
+                        # close_output() would fail to flush it again
+                        try:
+                            out_fp.close()
+                        except OSError:
+                            pass
+                if pipe:
+                    try:
+                        pipe.write(chunk)
+                    except BrokenPipeError:
+                        pipe = None
+        finally:
+            source.close()
+            if pipe:
+                try:
+                    pipe.close()
+                except BrokenPipeError:
+                    pass
+
+        return error
+
+    @staticmethod
+    def wait(proc):
+        """Wait for proc to finish. Return $? and the resource usage of proc,
+        including the processes it waited for, e.g. the ones of a shell"""
+
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        return proc.returncode, rusage
+
+    def write_metrics(self, stage_dir, ret, wall_time, rusage):
+        """Save the resource usage of one stage at stage_dir/metrics.json.
+        rusage is None if the stage did not run, e.g. a cache hit"""
+
+        metrics = {"return_code": ret,
+                   "wall_time": round(wall_time, 3)}
+
+        if rusage:
+            # ru_maxrss is in KiB and blocks are 512 bytes on Linux. The child
+            # is a fork of popype before the exec, so max_rss is never smaller
+            # than popype itself.
+            metrics["user_time"] = round(rusage.ru_utime, 3)
+            metrics["sys_time"] = round(rusage.ru_stime, 3)
+            metrics["max_rss"] = rusage.ru_maxrss << 10
+            metrics["read_bytes"] = rusage.ru_inblock << 9
+            metrics["write_bytes"] = rusage.ru_oublock << 9
+        else:
+            metrics["cached"] = True
+
+        # Size on disk, compressed or not. Not stdout.delta
+        for key, name in [("stdout_bytes", self.stdout_name),
+                          ("stderr_bytes", "stderr")]:
+            if os.path.exists(stage_dir + "/" + name):
+                metrics[key] = os.path.getsize(stage_dir + "/" + name)
+
+        with open(stage_dir + "/metrics.json", "w") as metrics_fp:
+            json.dump(metrics, metrics_fp, indent=1, sort_keys=True)
+
+    def __inproc(self, cwd, command, func, iscritical=False):
+        """Internal function that calls func() instead of forking a shell to run
+        command. command is only used for logging, the log is the same as if
+        command was executed by __call(). Return [$?] like __call()"""
+
+        log_str = "cd " + cwd + "; " + command
+
+        with self.lock:
+            self.forks_avoided += 1
+
+        try:
+            func()
+            ret = 0
+        except OSError as err:
+            log_str += " (" + str(err) + ")"
+            ret = 1
+
+        if ret:
+            log_str += " ($? = " + str(ret) + ")"
+            if iscritical:
+                self.exit(log_str + "returned error " + str(ret))
+        logging.info(log_str)
+
+        return [ret]
+
+    def __call(self, cwd, command_list, iscritical=False):
         """Internal function that uses subprocess.call. This should not be used
-        outside this class. Expect a list of strings to be executed.
-        Set self.cwd before calling this method."""
+        outside this class. Expect a list of strings to be executed on cwd.
+        cwd is a parameter instead of self.cwd as more than one pipeline can be
+        running at the same time."""
         ret_list = []
 
         for command in command_list:
-            log_str = "cd " + self.cwd + "; " + str(command)
-            ret = subprocess.call(command, shell=True, cwd=self.cwd)
+            log_str = "cd " + cwd + "; " + str(command)
+            ret = subprocess.call(command, shell=True, cwd=cwd)
             if ret:
                 log_str += " ($? = " + str(ret) + ")"
                 if iscritical:
@@ -598,12 +4246,107 @@ class ExecTools:
 
         return ret_list
 
+def inprocess_stage(script, stage_dir, args, codec):
+    """Run a stage on this process, see Pipeline.inprocess_run. script must
+    define popype_stage(lines, args), where lines iterates over the lines of
+    the stdout of the previous stage, empty for the first stage, and args is a
+    dict with checkout, pipedir, pipeidx, pipestderr, pipestdout and src_dir.
+    It returns an iterable of lines, the stdout of the stage, and fails by
+    raising. The module of script is loaded once per process, and again only
+    if script changes. Return $? and the resource usage of the stage."""
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+
+    exe = ExecTools()
+    exe.codec = codec
+    if codec:
+        exe.stdout_name = "stdout" + codec.ext
+
+    with open(stage_dir + "/stderr", "w") as err_fp:
+        try:
+            mtime = os.path.getmtime(script)
+            if INPROC_MODULES.get(script, (None, 0))[1] != mtime:
+                spec = importlib.util.spec_from_file_location(
+                    "popype_stage_" + str(len(INPROC_MODULES)), script)
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+                INPROC_MODULES[script] = (module, mtime)
+            module = INPROC_MODULES[script][0]
+
+            os.chdir(args["src_dir"])
+            lines = iter([])
+            if args["pipestdout"]:
+                lines = exe.read_lines(args["pipestdout"])
+            exe.write_lines(stage_dir, (x if x.endswith("\n") else x + "\n"
+                                        for x in module.popype_stage(lines,
+                                                                     args)))
+            ret = 0
+        except Exception:
+            traceback.print_exc(file=err_fp)
+            ret = 1
+
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    rusage = types.SimpleNamespace(
+        **{field: getattr(after, field) - getattr(before, field)
+           for field in ["ru_utime", "ru_stime", "ru_inblock", "ru_oublock"]})
+    rusage.ru_maxrss = after.ru_maxrss
+
+    return ret, rusage
+
 def main():
     """ Good old main """
 
+    parser = argparse.ArgumentParser(description="Run the pipeline described "
+                                     "at " + JOB_CONF)
+    parser.add_argument("--coordinator", action="store_true",
+                        help="add the checkouts to the [queue] and wait for "
+                        "the workers")
+    parser.add_argument("--worker", action="store_true",
+                        help="run the pipeline for checkouts leased from the "
+                        "[queue]")
+    parser.add_argument("--index", action="store_true",
+                        help="add the results already on git_out to the "
+                        "[index]")
+    parser.add_argument("--query", metavar="KEY",
+                        help="print the checkouts and stages with rows whose "
+                        "first field is KEY, using the [index]")
+    parser.add_argument("--query-file", metavar="FILE",
+                        help="print the checkouts and stages with rows for "
+                        "FILE, using the [index]")
+    parser.add_argument("--reconstruct", nargs=2,
+                        metavar=("CHECKOUT", "STAGE"),
+                        help="print the output of STAGE for CHECKOUT, rebuilt "
+                        "from the [git_out] deltas if needed")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep git_in ready and run the jobs sent with "
+                        "--submit")
+    parser.add_argument("--submit", metavar="JOB_CONF",
+                        help="run JOB_CONF on the daemon and wait for it")
+    args = parser.parse_args()
+
+    if args.daemon:
+        Daemon().serve()
+    if args.submit:
+        exit(Daemon.submit(args.submit))
+
     # This isn't the most elegant solution
     mypipeline = Pipeline()
 
+    if args.coordinator:
+        mypipeline.coordinator_run()
+    elif args.worker:
+        mypipeline.worker_run()
+    elif args.index:
+        mypipeline.index_run()
+    elif args.query:
+        mypipeline.query_run("key", args.query)
+    elif args.query_file:
+        mypipeline.query_run("file", args.query_file)
+    elif args.reconstruct:
+        mypipeline.reconstruct_run(*args.reconstruct)
+    else:
+        mypipeline.pipeline_run()
+
 #    for checkout in git_in:
 #        checkout.checkout()
 #        pipeline.set_env(checkout.get_env())
@@ -641,7 +4384,7 @@ def main():
     #print(myconf.git_out.conf.repo_dir)
     #print(myconf.git_out.conf.ssl_key_path)
 
-    myexec.exit("That's all folks!", error=False)
+    mypipeline.exe.exit("That's all folks!", error=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""Measure the overhead of popype itself, without spatch. Build a synthetic
+git_in repository with tags tags of files files each, a bare repository on
+the same machine standing in for git_out, and stub stages that print rows
+rows at rate rows per second. Then run Pipeline end to end and report the
+time spent on each phase: init, checkout, stage, compress, commit, push, and
+the shell forks popype avoided. git runs with a global config of its own.
+
+    ./popype_bench.py --tags 10 --files 2000 --json new.json
+    ./popype_bench.py --tags 10 --files 2000 --compare new.json
+
+The same arguments and seed make the same repositories, so two versions of
+popype.py can be compared. --compare fails when a phase got slower than
+threshold percent. --set section.option=value adds options to the job_conf,
+e.g. --set git_out.batch_count=20 or --set pipeline.streamable=stub1.py"""
+
+import argparse, json, logging, os, random, shutil, statistics, subprocess
+import sys, tempfile, threading, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import popype
+
+# Methods timed for each phase. Time spent on a phase called from another one
+# counts only for the inner one. stdout is compressed while the stage writes
+# it, so compress is stderr only. push runs on the background.
+PHASES = {
+    "init": [(popype.GitRepo, "init")],
+    "checkout": [(popype.GitRepo, "git_checkout"),
+                 (popype.GitRepo, "reset_clean"),
+                 (popype.GitRepo, "worktree_add"),
+                 (popype.GitRepo, "worktree_remove")],
+    "stage": [(popype.Pipeline, "stage_exec"),
+              (popype.Pipeline, "stream_run")],
+    "compress": [(popype.ExecTools, "compress")],
+    "commit": [(popype.GitRepo, "add_commit_push"),
+               (popype.CommitBatcher, "commit")],
+    "push": [(popype.CommitBatcher, "push")],
+}
+
+STUB = """#!/usr/bin/env python3
+# Stub stage: read the stdout of the stage before, if any, and print %d rows
+# at %d rows per second, 0 is as fast as possible
+import sys, time
+if len(sys.argv) > 1 and sys.argv[1]:
+    with open(sys.argv[1], "rb") as in_fp:
+        while in_fp.read(1 << 20):
+            pass
+rows, rate, start = %d, %d, time.time()
+for idx in range(0, rows, 1000):
+    sys.stdout.write("".join("key%%d,dir%%d/file%%d.c,%%d\\n" %%
+                             (x %% 1000, x %% 97, x %% %d, x)
+                             for x in range(idx, min(idx + 1000, rows))))
+    if rate:
+        time.sleep(max(0, start + (idx + 1000) / rate - time.time()))
+"""
+
+class PhaseTimer:
+    """Wrap the methods of PHASES to add up their time, per phase"""
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.seconds = {}
+
+    def wrap(self, phase, func):
+        """Return func, timed as phase"""
+
+        def timed(*args, **kwargs):
+            stack = self.local.__dict__.setdefault("stack", [])
+            stack.append(0)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                inner = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                with self.lock:
+                    self.seconds[phase] = (self.seconds.get(phase, 0) +
+                                           elapsed - inner)
+                    self.calls[phase] = self.calls.get(phase, 0) + 1
+
+        return timed
+
+    def install(self):
+        """Wrap the methods of PHASES. Return a function that undoes it"""
+
+        saved = []
+        for phase, methods in PHASES.items():
+            for cls, name in methods:
+                func = cls.__dict__[name]
+                saved.append((cls, name, func))
+                setattr(cls, name, self.wrap(phase, func))
+
+        def uninstall():
+            for cls, name, func in saved:
+                setattr(cls, name, func)
+
+        return uninstall
+
+def git(cwd, *args):
+    """Run git with args on cwd"""
+
+    subprocess.run(["git"] + list(args), cwd=cwd, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def make_source(path, args):
+    """Create the git_in repository at path, with tags v1..v<tags>. Each tag
+    changes churn of the files"""
+
+    rand = random.Random(args.seed)
+    git(os.path.dirname(path), "init", "-q", path)
+
+    changed = range(args.files)
+    for tag in range(1, args.tags + 1):
+        for idx in changed:
+            name = path + "/dir" + str(idx % 97) + "/file" + str(idx) + ".c"
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            with open(name, "w") as src_fp:
+                src_fp.writelines("int f%d_%d(int x) { printk(\"%d\"); "
+                                  "return x + %d; }\n" %
+                                  (idx, line, tag, rand.randint(0, 1 << 30))
+                                  for line in range(args.lines))
+
+        git(path, "add", "-A")
+        git(path, "commit", "-q", "-m", "v" + str(tag))
+        git(path, "tag", "v" + str(tag))
+
+        changed = rand.sample(range(args.files),
+                              max(1, int(args.files * args.churn)))
+
+def make_job(work_dir, args):
+    """Write popype_conf, job_conf, the git config of git_in and the stub
+    stages on work_dir"""
+
+    with open(work_dir + "/gitconfig", "w") as conf_fp:
+        conf_fp.write("[core]\n"
+                      "\trepositoryformatversion = 0\n"
+                      "\tfilemode = true\n"
+                      "\tbare = false\n"
+                      "[remote \"origin\"]\n"
+                      "\turl = " + work_dir + "/src\n"
+                      "\tfetch = +refs/heads/*:refs/remotes/origin/*\n")
+
+    with open(work_dir + "/popype_conf", "w") as conf_fp:
+        conf_fp.write("[dir]\n"
+                      "dl_dir: ${tmp_dir}\n"
+                      "git_out_dir: " + work_dir + "/git_out\n"
+                      "git_in_dir: " + work_dir + "/git_in\n"
+                      "log_file: ${tmp_dir}/popype.log\n"
+                      "ssl_key_dir: " + work_dir + "/ssh\n"
+                      "tmp_dir: " + work_dir + "/tmp\n"
+                      "worktree_dir: ${tmp_dir}/worktrees\n")
+
+    os.makedirs(work_dir + "/scripts", exist_ok=True)
+    stages = []
+    for idx in range(args.stages):
+        name = "stub" + str(idx) + ".py"
+        with open(work_dir + "/scripts/" + name, "w") as stub_fp:
+            stub_fp.write(STUB % (args.rows, args.rate, args.rows, args.rate,
+                                  args.files))
+        os.chmod(work_dir + "/scripts/" + name, 0o755)
+        stages.append(name)
+
+    sections = {
+        "com": {"name": "bench", "author": "bench",
+                "email": "bench@localhost"},
+        "git_in": {"config_url": "file://" + work_dir + "/gitconfig",
+                   "checkout": ", ".join("v" + str(x) for x in
+                                         range(1, args.tags + 1)),
+                   "workers": str(args.workers)},
+        "git_out": {"repo_url": work_dir + "/out.git",
+                    "branch": "${com:name}", "compress": args.compress,
+                    "key": "none"},
+        "pipeline": {"pipeline": " | ".join(stages)},
+        "cmd_line_args": {"py": "#PIPESTDOUT#"},
+    }
+    for item in args.set:
+        option, value = item.split("=", 1)
+        section, option = option.split(".", 1)
+        sections.setdefault(section, {})[option] = value
+
+    with open(work_dir + "/job_conf", "w") as conf_fp:
+        for section, options in sections.items():
+            conf_fp.write("[" + section + "]\n")
+            conf_fp.writelines(x + ": " + options[x] + "\n" for x in options)
+            conf_fp.write("\n")
+
+def make_out(work_dir):
+    """Create the bare git_out repository, with a first commit to clone"""
+
+    shutil.rmtree(work_dir + "/out.git", ignore_errors=True)
+    git(work_dir, "init", "-q", "--bare", "out.git")
+
+    seed_dir = tempfile.mkdtemp(dir=work_dir)
+    git(seed_dir, "clone", "-q", work_dir + "/out.git", ".")
+    with open(seed_dir + "/README", "w") as readme_fp:
+        readme_fp.write("popype benchmark\n")
+    git(seed_dir, "add", "README")
+    git(seed_dir, "commit", "-q", "-m", "init")
+    git(seed_dir, "push", "-q", "origin", "HEAD:master")
+    shutil.rmtree(seed_dir)
+
+def run_once(work_dir):
+    """Run the job on work_dir from scratch. Return the wall time, the
+    PhaseTimer and the shell forks popype avoided"""
+
+    make_out(work_dir)
+    for name in ["git_in", "git_out", "tmp"]:
+        shutil.rmtree(work_dir + "/" + name, ignore_errors=True)
+    os.makedirs(work_dir + "/tmp")
+
+    # git and the stages write to the stdout and stderr of this process, keep
+    # that out of the report
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    out_fd = os.open(work_dir + "/popype.out",
+                     os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    os.dup2(out_fd, 1)
+    os.dup2(out_fd, 2)
+
+    timer = PhaseTimer()
+    uninstall = timer.install()
+    start = time.time()
+    try:
+        pipeline = popype.Pipeline()
+        pipeline.pipeline_run()
+        pipeline.job.git_out.batcher.flush()
+    finally:
+        uninstall()
+        for fd, saved_fd in enumerate(saved, 1):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        os.close(out_fd)
+
+    return time.time() - start, timer, pipeline.exe.forks_avoided
+
+def report(result, old=None, threshold=0):
+    """Print the phases of result, and how they changed since old. Return
+    the phases slower than threshold percent"""
+
+    slower = []
+    print("%-10s %8s %10s %8s" % ("phase", "calls", "seconds", "change"))
+    for phase in ["wall"] + list(PHASES):
+        seconds = result["phases"].get(phase, {}).get("seconds", 0)
+        calls = result["phases"].get(phase, {}).get("calls", "")
+        change = ""
+        if old and phase in old["phases"]:
+            before = old["phases"][phase]["seconds"]
+            if before > 0:
+                percent = (seconds - before) * 100 / before
+                change = "%+.1f%%" % percent
+                if percent > threshold:
+                    slower.append(phase)
+        print("%-10s %8s %10.3f %8s" % (phase, calls, seconds, change))
+
+    # Shell forks replaced by in-process file operations, the same on every
+    # run of the same job
+    change = ""
+    if old and "forks_avoided" in old:
+        change = "%+d" % (result["forks_avoided"] - old["forks_avoided"])
+    print("%-10s %8s %10s %8s" % ("forks", "", result["forks_avoided"],
+                                  change))
+
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tags", type=int, default=5)
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--lines", type=int, default=20,
+                        help="lines per file")
+    parser.add_argument("--churn", type=float, default=0.1,
+                        help="fraction of the files changed by each tag")
+    parser.add_argument("--stages", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=20000,
+                        help="rows printed by each stage")
+    parser.add_argument("--rate", type=int, default=0,
+                        help="rows per second of each stage, 0 is no limit")
+    parser.add_argument("--compress", default="gz")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--set", action="append", default=[],
+                        metavar="SECTION.OPTION=VALUE",
+                        help="extra job_conf option")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs, the median of each phase is reported")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dir", help="work directory, kept at the end")
+    parser.add_argument("--json", help="save the results to JSON")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="compare with results saved by --json")
+    parser.add_argument("--threshold", type=float, default=20,
+                        help="percent slower that --compare fails on")
+    args = parser.parse_args()
+
+    # popype logs every command it runs
+    logging.basicConfig(level=logging.WARNING)
+
+    # Same repositories for the same arguments
+    for var in ["AUTHOR", "COMMITTER"]:
+        os.environ["GIT_" + var + "_NAME"] = "bench"
+        os.environ["GIT_" + var + "_EMAIL"] = "bench@localhost"
+        os.environ["GIT_" + var + "_DATE"] = "2015-11-05T00:00:00Z"
+
+    work_dir = os.path.abspath(args.dir or tempfile.mkdtemp())
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+
+    # popype runs git config --global, that must not touch the git config of
+    # whoever runs the benchmark
+    os.makedirs(work_dir + "/home", exist_ok=True)
+    os.environ["HOME"] = work_dir + "/home"
+    os.environ["GIT_CONFIG_GLOBAL"] = work_dir + "/home/.gitconfig"
+    os.environ["GIT_CONFIG_NOSYSTEM"] = "1"
+    popype.SCRIPT_DIR = work_dir + "/scripts/"
+
+    try:
+        shutil.rmtree(work_dir + "/src", ignore_errors=True)
+        start = time.time()
+        make_source(work_dir + "/src", args)
+        make_job(work_dir, args)
+        print("setup: %.1fs" % (time.time() - start))
+
+        runs = [run_once(work_dir) for _ in range(args.repeat)]
+    finally:
+        if not args.dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    phases = {"wall": {"seconds": statistics.median(x[0] for x in runs),
+                       "calls": 1}}
+    for phase in PHASES:
+        phases[phase] = {
+            "seconds": statistics.median(timer.seconds.get(phase, 0)
+                                         for _, timer, _ in runs),
+            "calls": runs[0][1].calls.get(phase, 0)}
+
+    params = {x: y for x, y in vars(args).items()
+              if x not in ["dir", "json", "compare", "threshold"]}
+    result = {"params": params, "phases": phases,
+              "forks_avoided": runs[0][2], "python": sys.version.split()[0]}
+
+    old = None
+    if args.compare:
+        with open(args.compare) as old_fp:
+            old = json.load(old_fp)
+        if old["params"] != params:
+            print("warning: " + args.compare + " was made with other "
+                  "arguments")
+
+    slower = report(result, old, args.threshold)
+
+    if args.json:
+        with open(args.json, "w") as json_fp:
+            json.dump(result, json_fp, indent=1)
+
+    if slower:
+        print("slower than " + str(args.threshold) + "%: " +
+              ", ".join(slower))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Fixtures of the popype tests. popype.py is a script, it is imported from
+docker/. A job runs popype.py on a subprocess, on a work dir of its own with
+a git global config of its own, see Job."""
+
+import gzip, os, subprocess, sys
+
+import pytest
+
+DOCKER_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "docker")
+sys.path.insert(0, DOCKER_DIR)
+
+# popype.py, with the stages on the scripts dir of the work dir
+RUNNER = ("import sys; sys.path.insert(0, %r); import popype; "
+          "popype.SCRIPT_DIR = sys.argv.pop(1); popype.main()" % DOCKER_DIR)
+
+CHECKOUTS = ["v1", "v2", "v3", "v4"]
+
+
+def git(cwd, *args, env=None):
+    """Run git with args on cwd, return its stdout"""
+
+    return subprocess.run(["git"] + list(args), cwd=cwd, env=env, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          text=True).stdout
+
+
+class Job:
+    """A git_in repository with the tags of CHECKOUTS, vN has the files
+    d1/f1.c to dN/f5.c, a bare repository standing in for git_out, and the
+    config files of popype.py, all on work_dir. Stages can import popype"""
+
+    def __init__(self, work_dir):
+        self.work_dir = str(work_dir)
+        self.env = dict(os.environ,
+                        HOME=self.work_dir + "/home",
+                        GIT_CONFIG_GLOBAL=self.work_dir + "/home/.gitconfig",
+                        GIT_CONFIG_NOSYSTEM="1", PYTHONPATH=DOCKER_DIR)
+        os.makedirs(self.env["HOME"])
+        os.makedirs(self.work_dir + "/scripts")
+        os.makedirs(self.work_dir + "/tmp")
+        git(self.work_dir, "config", "--global", "user.name", "test",
+            env=self.env)
+        git(self.work_dir, "config", "--global", "user.email", "test@test",
+            env=self.env)
+
+        src = self.work_dir + "/src"
+        git(self.work_dir, "init", "-q", src, env=self.env)
+        for tag, checkout in enumerate(CHECKOUTS, 1):
+            os.makedirs(src + "/d" + str(tag))
+            for idx in range(1, 6):
+                with open(src + "/d%d/f%d.c" % (tag, idx), "w") as src_fp:
+                    src_fp.write("int f%d(){ printk(\"x\"); return %d; }\n" %
+                                 (idx, tag))
+            git(src, "add", "-A", env=self.env)
+            git(src, "commit", "-q", "-m", checkout, env=self.env)
+            git(src, "tag", checkout, env=self.env)
+
+        git(self.work_dir, "init", "-q", "--bare", "out.git", env=self.env)
+        seed = self.work_dir + "/seed"
+        git(self.work_dir, "clone", "-q", "out.git", seed, env=self.env)
+        with open(seed + "/README", "w") as readme_fp:
+            readme_fp.write("popype tests\n")
+        git(seed, "add", "README", env=self.env)
+        git(seed, "commit", "-q", "-m", "init", env=self.env)
+        git(seed, "push", "-q", "origin", "HEAD:master", env=self.env)
+
+        with open(self.work_dir + "/gitconfig", "w") as conf_fp:
+            conf_fp.write("[core]\n"
+                          "\trepositoryformatversion = 0\n"
+                          "\tfilemode = true\n"
+                          "\tbare = false\n"
+                          "[remote \"origin\"]\n"
+                          "\turl = " + src + "\n"
+                          "\tfetch = +refs/heads/*:refs/remotes/origin/*\n")
+
+        with open(self.work_dir + "/popype_conf", "w") as conf_fp:
+            conf_fp.write("[dir]\n"
+                          "dl_dir: ${tmp_dir}\n"
+                          "git_out_dir: " + self.work_dir + "/git_out\n"
+                          "git_in_dir: " + self.work_dir + "/git_in\n"
+                          "log_file: ${tmp_dir}/popype.log\n"
+                          "ssl_key_dir: " + self.work_dir + "/home/.ssh\n"
+                          "tmp_dir: " + self.work_dir + "/tmp\n"
+                          "worktree_dir: ${tmp_dir}/worktrees\n")
+
+    def script(self, name, text):
+        """Save the stage name"""
+
+        path = self.work_dir + "/scripts/" + name
+        with open(path, "w") as script_fp:
+            script_fp.write(text)
+        os.chmod(path, 0o755)
+
+    def write(self, stages, **sections):
+        """Write the job_conf of the pipeline stages, sections are more
+        options, e.g. git_out={"resume": "yes"}"""
+
+        conf = {
+            "com": {"name": "job", "author": "test", "email": "test@test"},
+            "git_in": {"config_url": "file://" + self.work_dir + "/gitconfig",
+                       "checkout": ", ".join(CHECKOUTS)},
+            "git_out": {"repo_url": self.work_dir + "/out.git",
+                        "branch": "${com:name}", "compress": "no",
+                        "key": "none"},
+            "pipeline": {"pipeline": stages},
+            "cmd_line_args": {"sh": "#PIPEIDX#",
+                              "py": "--pipestdout #PIPESTDOUT#"},
+        }
+        for section, options in sections.items():
+            conf.setdefault(section, {}).update(options)
+
+        with open(self.work_dir + "/job_conf", "w") as conf_fp:
+            for section, options in conf.items():
+                conf_fp.write("[" + section + "]\n")
+                conf_fp.writelines(x + ": " + options[x] + "\n"
+                                   for x in options)
+                conf_fp.write("\n")
+
+    def run(self, *args):
+        """Run popype.py with args, return the CompletedProcess. popype.py
+        always exits with 1"""
+
+        return subprocess.run([sys.executable, "-c", RUNNER,
+                               self.work_dir + "/scripts/"] + list(args),
+                              cwd=self.work_dir, env=self.env,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              text=True, timeout=300)
+
+    def show(self, path):
+        """Return the file at path on the job dir of git_out, decompressed if
+        it is a .gz, or None"""
+
+        show = subprocess.run(["git", "show", "job:job/" + path],
+                              cwd=self.work_dir + "/out.git", env=self.env,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if show.returncode:
+            return None
+        if path.endswith(".gz"):
+            return gzip.decompress(show.stdout).decode()
+        return show.stdout.decode()
+
+    def untracked(self):
+        """Return the files on the working tree of git_out that git doesn't
+        track"""
+
+        return git(self.work_dir + "/git_out", "status", "--porcelain",
+                   "--ignored", env=self.env).splitlines()
+
+
+@pytest.fixture
+def job(tmp_path):
+    """A Job on a temporary dir"""
+
+    return Job(tmp_path)
@@ -0,0 +1,72 @@
+"""Aggregate, the .agg stages"""
+
+import configparser, io
+
+import pytest
+
+import popype
+
+ROWS = b"".join(b"%s,f%d.c,%d\n" % (func, idx % 3, idx) for idx, func in
+                enumerate([b"printk", b"kmalloc", b"printk", b"pr_err",
+                           b"printk", b"kfree", b"kmalloc"]))
+
+
+def aggregate(rows, **options):
+    """Return the output of Aggregate with options on rows"""
+
+    conf = configparser.ConfigParser()
+    conf["aggregate"] = options
+
+    return popype.Aggregate(conf["aggregate"]).run(io.BytesIO(rows))
+
+
+def test_group_count():
+    assert aggregate(ROWS, op="group_count") == [
+        b"kfree,1\n", b"kmalloc,2\n", b"pr_err,1\n", b"printk,3\n"]
+    assert aggregate(ROWS, op="group_count", key="1") == [
+        b"f0.c,3\n", b"f1.c,2\n", b"f2.c,2\n"]
+
+
+def test_min_keys_only():
+    assert aggregate(ROWS, op="group_count", min="2") == [
+        b"kmalloc,2\n", b"printk,3\n"]
+    assert aggregate(ROWS, op="group_count", min="2", keys_only="yes") == [
+        b"kmalloc\n", b"printk\n"]
+
+
+def test_distinct():
+    # Files with calls to each function, printk twice on f0.c
+    assert aggregate(ROWS + b"printk,f0.c,7\n", op="distinct", value="1") == [
+        b"kfree,1\n", b"kmalloc,2\n", b"pr_err,1\n", b"printk,3\n"]
+
+
+def test_regex_bucket():
+    assert aggregate(ROWS, op="regex_bucket",
+                     buckets="print: ^pr, memory: ^k(malloc|free)$") == [
+        b"memory,3\n", b"print,4\n"]
+    assert aggregate(ROWS, op="regex_bucket", buckets="print: ^printk$") == [
+        b"other,4\n", b"print,3\n"]
+
+
+def test_top_k():
+    assert aggregate(ROWS, op="top_k", k="2") == [b"printk,3\n",
+                                                  b"kmalloc,2\n"]
+
+
+def test_short_rows():
+    # No newline at the end, empty lines and rows without the column
+    assert aggregate(b"a,1\n\nb\na,2\nb,3", op="group_count", key="1") == [
+        b"1,1\n", b"2,1\n", b"3,1\n"]
+    assert aggregate(b"a,1\nb\n", op="distinct", value="1") == [b"a,1\n"]
+
+
+def test_batches():
+    # Rows across the reads of run()
+    rows = b"".join(b"key%d,%d\n" % (x % 7, x) for x in range(500000))
+    assert aggregate(rows, op="group_count") == [
+        b"key%d,%d\n" % (x, len(range(x, 500000, 7))) for x in range(7)]
+
+
+def test_bad_op():
+    with pytest.raises(ValueError):
+        aggregate(ROWS, op="sum")
@@ -0,0 +1,54 @@
+"""CommitBatcher"""
+
+import time, types
+
+import popype
+from conftest import git
+
+
+def batcher(**options):
+    """Return a CommitBatcher of a GitRepo with the [git_out] options"""
+
+    conf = popype.GitRepoConfig("")
+    for option, value in options.items():
+        setattr(conf, option, value)
+
+    return popype.CommitBatcher(types.SimpleNamespace(conf=conf))
+
+
+def test_batch_count():
+    commits = batcher(batch_count=3)
+    commits.pending = ["a", "b"]
+    assert not commits.isfull()
+    commits.pending.append("c")
+    assert commits.isfull()
+
+
+def test_batch_bytes():
+    commits = batcher(batch_count=100, batch_bytes=1000)
+    commits.pending = ["a"]
+    commits.size = 999
+    assert not commits.isfull()
+    commits.size = 1000
+    assert commits.isfull()
+
+
+def test_batch_seconds():
+    commits = batcher(batch_count=100, batch_seconds=60)
+    commits.pending = ["a"]
+    commits.first_time = time.time()
+    assert not commits.isfull()
+    commits.first_time -= 60
+    assert commits.isfull()
+
+
+def test_batches(job):
+    # 4 checkouts of 2 stages, and the metrics summary at the end
+    job.script("grep_calls.sh", "#!/bin/sh\ngrep -rn printk .\n")
+    job.write("grep_calls.sh | grep_calls.sh", git_out={"batch_count": "3"})
+    job.run()
+
+    log = git(job.work_dir + "/out.git", "log", "--format=%s", "job",
+              env=job.env).splitlines()
+    assert log == ["3 results"] * 3 + ["init"]
+    assert job.show("v4/1/stdout") is not None
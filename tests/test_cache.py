@@ -0,0 +1,49 @@
+"""StageCache"""
+
+import os
+
+import popype
+
+
+def stage_dir(path, stdout):
+    """Make a stage dir at path with stdout and an empty stderr"""
+
+    path.mkdir()
+    (path / "stdout").write_bytes(stdout)
+    (path / "stderr").write_bytes(b"")
+
+    return str(path)
+
+
+def test_get_put(tmp_path):
+    cache = popype.StageCache(popype.ExecTools(), str(tmp_path / "cache"),
+                              1 << 20)
+    stage = stage_dir(tmp_path / "stage", b"printk,1\n")
+    out = str(tmp_path / "out")
+    os.mkdir(out)
+
+    assert not cache.get("key", out)
+    cache.put("key", stage)
+    assert cache.get("key", out)
+    with open(out + "/stdout", "rb") as stdout_fp:
+        assert stdout_fp.read() == b"printk,1\n"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_evict(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    cache = popype.StageCache(popype.ExecTools(), cache_dir, 250)
+
+    for idx, key in enumerate(["a", "b"]):
+        cache.put(key, stage_dir(tmp_path / key, b"x" * 100))
+        os.utime(cache_dir + "/" + key, (idx, idx))
+
+    # a was used last, b goes first
+    os.mkdir(str(tmp_path / "out"))
+    assert cache.get("a", str(tmp_path / "out"))
+    cache.put("c", stage_dir(tmp_path / "c", b"x" * 100))
+    assert sorted(os.listdir(cache_dir)) == ["a", "c"]
+
+    # An entry bigger than the cache doesn't stay
+    cache.put("d", stage_dir(tmp_path / "d", b"x" * 300))
+    assert os.listdir(cache_dir) == []
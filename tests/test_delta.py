@@ -0,0 +1,99 @@
+"""[git_out] delta: stdout.delta, --reconstruct and resume"""
+
+from conftest import CHECKOUTS
+
+# Rows in reverse order, stdout is not what the deltas rebuild
+GREP_CALLS = """#!/bin/sh
+grep -rn printk --include=*.c . | sed 's/:.*//' | sort -r |
+    awk '{print "printk," $1}'
+"""
+
+# The first row of its input
+FIRST = """#!/usr/bin/env python3
+import sys
+with open(sys.argv[2]) as in_fp:
+    print(in_fp.readline(), end="")
+"""
+
+
+def rows(checkout):
+    """The rows of grep_calls.sh for checkout, sorted"""
+
+    count = CHECKOUTS.index(checkout) + 1
+    return "".join("printk,./d%d/f%d.c\n" % (tag, idx)
+                   for tag in range(1, count + 1) for idx in range(1, 6))
+
+
+def test_delta_reconstruct(job):
+    job.script("grep_calls.sh", GREP_CALLS)
+    job.write("grep_calls.sh", git_out={"delta": "grep_calls.sh"})
+    job.run()
+
+    assert job.show("v1/0/stdout") is not None
+    for prev, checkout in zip(CHECKOUTS, CHECKOUTS[1:]):
+        assert job.show(checkout + "/0/stdout") is None
+        delta = job.show(checkout + "/0/stdout.delta").splitlines()
+        assert delta[0].startswith("=" + prev + " ")
+        assert delta[1:] == ["+" + x for x in rows(checkout).splitlines()
+                             if x not in rows(prev)]
+
+    out = job.run("--reconstruct", "v3", "grep_calls.sh")
+    assert out.stdout == rows("v3")
+
+
+def test_resume_delta(job):
+    job.script("grep_calls.sh", GREP_CALLS)
+    job.script("first.py", FIRST)
+    job.write("grep_calls.sh | first.py",
+              git_out={"delta": "grep_calls.sh", "resume": "yes"})
+    job.run()
+    first = {x: job.show(x + "/1/stdout") for x in CHECKOUTS}
+    assert first["v3"] == "printk,./d3/f5.c\n"
+
+    # Nothing changed, nothing runs
+    assert "returned" not in job.run().stdout
+
+    # first.py runs again and needs the rows of grep_calls.sh as they were,
+    # not the sorted ones rebuilt from the deltas
+    job.script("first.py", FIRST + "# again\n")
+    out = job.run().stdout
+    assert "v1: grep_calls.sh returned" not in out
+    assert "v3: grep_calls.sh returned" in out
+    assert "v3: first.py returned" in out
+    assert {x: job.show(x + "/1/stdout") for x in CHECKOUTS} == first
+
+
+def test_delta_failed_prev(job):
+    # v0 doesn't exist, v1 doesn't wait forever for it
+    job.script("grep_calls.sh", GREP_CALLS)
+    job.write("grep_calls.sh", git_in={"checkout": "v0, v1", "workers": "2"},
+              git_out={"delta": "grep_calls.sh"})
+    out = job.run()
+
+    assert "delta: v0 failed" in out.stderr
+    assert job.show("v1/0/stdout") == "".join(reversed(
+        rows("v1").splitlines(True)))
+
+
+# Rows removed, added and repeated from one checkout to the next
+ROWS = """#!/bin/sh
+case $(git describe --tags) in
+v1) printf 'a\\nb\\nb\\n';;
+v2) printf 'b\\nc\\n';;
+v3) printf 'c\\na\\na\\nc\\n';;
+esac
+"""
+
+
+def test_reconstruct_round_trip(job):
+    job.script("rows.sh", ROWS)
+    job.write("rows.sh", git_out={"delta": "rows.sh", "compress": "gz"})
+    job.run()
+
+    delta = job.show("v3/0/stdout.delta").splitlines(True)
+    assert delta[0].startswith("=v2 ")
+    assert delta[1:] == ["-b\n", "+a\n", "+a\n", "+c\n"]
+
+    for checkout, rows in [("v1", "a\nb\nb\n"), ("v2", "b\nc\n"),
+                           ("v3", "a\na\nc\nc\n"), ("v4", "")]:
+        assert job.run("--reconstruct", checkout, "0").stdout == rows
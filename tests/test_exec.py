@@ -0,0 +1,53 @@
+"""ExecTools"""
+
+import io, os, threading
+
+import popype
+
+
+def reader(read_fd, chunks):
+    """Read read_fd to the end on a thread, into chunks"""
+
+    def read():
+        with os.fdopen(read_fd, "rb") as read_fp:
+            chunks.append(read_fp.read())
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    return thread
+
+
+def test_tee():
+    data = b"row\n" * 100000
+    source = io.BufferedReader(io.BytesIO(data))
+    out_fp = io.BytesIO()
+    read_fd, write_fd = os.pipe()
+    chunks = []
+    thread = reader(read_fd, chunks)
+
+    assert popype.ExecTools.tee(source, out_fp, os.fdopen(write_fd, "wb")) \
+        is None
+    thread.join()
+    assert out_fp.getvalue() == data
+    assert chunks == [data]
+    assert source.closed
+
+
+def test_tee_broken_out_fp():
+    # The compressor of stdout died: the next stage still gets everything,
+    # and its stdin is closed
+    data = b"row\n" * 100000
+    source = io.BufferedReader(io.BytesIO(data))
+    out_read, out_write = os.pipe()
+    os.close(out_read)
+    out_fp = os.fdopen(out_write, "wb")
+    read_fd, write_fd = os.pipe()
+    chunks = []
+    thread = reader(read_fd, chunks)
+
+    error = popype.ExecTools.tee(source, out_fp, os.fdopen(write_fd, "wb"))
+    thread.join()
+    assert isinstance(error, BrokenPipeError)
+    assert out_fp.closed
+    assert chunks == [data]
+    assert source.closed
@@ -0,0 +1,48 @@
+"""Lookup"""
+
+import pytest
+
+import popype
+
+
+def test_lookup(tmp_path):
+    path = str(tmp_path / "lookup")
+    keys = [("key" + str(x)).encode() for x in range(1000)]
+    popype.Lookup.write(path, keys + keys[:10] + [b""])
+
+    lookup = popype.Lookup(path)
+    assert len(lookup) == 1000
+    assert all(x in lookup for x in keys)
+    assert "key999" in lookup
+    assert b"key1000" not in lookup
+    assert b"" not in lookup
+    lookup.close()
+
+
+def test_empty(tmp_path):
+    path = str(tmp_path / "lookup")
+    popype.Lookup.write(path, [])
+
+    lookup = popype.Lookup(path)
+    assert len(lookup) == 0
+    assert b"key" not in lookup
+
+
+def test_replaced(tmp_path):
+    # Readers of the old file keep it
+    path = str(tmp_path / "lookup")
+    popype.Lookup.write(path, [b"old"])
+    old = popype.Lookup(path)
+    popype.Lookup.write(path, [b"new"])
+
+    assert b"old" in old
+    assert b"new" in popype.Lookup(path)
+    assert b"old" not in popype.Lookup(path)
+
+
+def test_not_lookup(tmp_path):
+    path = tmp_path / "stdout"
+    path.write_bytes(b"printk,1\n" * 10)
+
+    with pytest.raises(ValueError):
+        popype.Lookup(str(path))
@@ -0,0 +1,37 @@
+"""MemoryBudget"""
+
+import popype
+
+MIB = 1 << 20
+
+
+def test_admit_fits(tmp_path):
+    memory = popype.MemoryBudget(str(tmp_path / "peaks.json"), 100 * MIB)
+    memory.update("a.cocci", 10 * MIB)
+
+    assert memory.admit(["a.cocci"], jobs=4) == (4, 40 * MIB)
+    assert memory.admit(["b.sh"]) == (0, 10 * MIB)
+
+
+def test_admit_fewer_jobs(tmp_path):
+    memory = popype.MemoryBudget(str(tmp_path / "peaks.json"), 100 * MIB)
+    memory.update("a.cocci", 10 * MIB)
+
+    # Alone, all that fits
+    jobs, reserved = memory.admit(["a.cocci"], jobs=16)
+    assert (jobs, reserved) == (10, 100 * MIB)
+    memory.release(reserved)
+
+    # Half of what is free while another stage runs
+    _, other = memory.admit(["a.cocci"], jobs=2)
+    assert memory.admit(["a.cocci"], jobs=16) == (4, 40 * MIB)
+    memory.release(other)
+
+
+def test_update_saves_peaks(tmp_path):
+    path = str(tmp_path / "peaks.json")
+    popype.MemoryBudget(path, 100 * MIB).update("a.cocci", 30 * MIB, 3)
+
+    memory = popype.MemoryBudget(path, 100 * MIB)
+    assert memory.peak("a.cocci") == 10 * MIB
+    assert memory.peak("unknown.sh") == 10 * MIB
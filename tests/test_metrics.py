@@ -0,0 +1,22 @@
+"""metrics.json of the stages and of the job"""
+
+import json
+
+from conftest import CHECKOUTS
+
+
+def test_metrics_summary(job):
+    job.script("grep_calls.sh", "#!/bin/sh\ngrep -rn printk .\n")
+    job.write("grep_calls.sh")
+    out = job.run()
+
+    metrics = json.loads(job.show("v2/0/metrics.json"))
+    assert metrics["return_code"] == 0
+    assert metrics["stdout_bytes"] > 0
+
+    summary = json.loads(job.show("metrics.json"))
+    assert summary["checkouts"] == len(CHECKOUTS)
+    assert summary["stages"]["grep_calls.sh"]["runs"] == len(CHECKOUTS)
+    assert summary["forks_avoided"] > 0
+    assert ("metrics: " + str(summary["forks_avoided"]) + " shell forks "
+            "avoided") in out.stderr
@@ -0,0 +1,44 @@
+"""TaskQueue"""
+
+import time
+
+import popype
+
+
+def test_lease(tmp_path):
+    queue = popype.TaskQueue(str(tmp_path / "q.sqlite"), 60)
+    queue.add(["v1", "v2"])
+    queue.add(["v1"])
+
+    assert queue.lease("w1") == "v1"
+    assert queue.lease("w2") == "v2"
+    assert queue.lease("w3") is None
+
+    queue.done("v1", "w1")
+    assert queue.status() == {"done": 1, "running": 1}
+
+
+def test_lease_expired(tmp_path):
+    queue = popype.TaskQueue(str(tmp_path / "q.sqlite"), 1)
+    queue.add(["v1", "v2"])
+    assert queue.lease("w1") == "v1"
+    assert queue.lease("w1") == "v2"
+
+    # w1 renews v2 but not v1, that goes to w2 once its lease expires
+    time.sleep(0.6)
+    queue.renew("v2", "w1")
+    assert queue.lease("w2") is None
+    time.sleep(0.5)
+    assert queue.lease("w2") == "v1"
+    assert queue.lease("w3") is None
+
+
+def test_done_not_leased(tmp_path):
+    queue = popype.TaskQueue(str(tmp_path / "q.sqlite"), 0)
+    queue.add(["v1"])
+    assert queue.lease("w1") == "v1"
+    queue.done("v1", "w1")
+
+    time.sleep(0.01)
+    assert queue.lease("w2") is None
+    assert queue.status() == {"done": 1}
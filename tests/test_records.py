@@ -0,0 +1,88 @@
+"""[pipeline] records and record_readers"""
+
+import io
+
+import popype
+
+CALLS = """#!/usr/bin/env python3
+import subprocess, sys
+import popype
+out = popype.RecordWriter(sys.stdout.buffer, "file:str, line:int")
+for row in subprocess.check_output(["grep", "-rn", "printk", "."],
+                                   text=True).splitlines():
+    name, line = row.split(":")[:2]
+    out.write((name, int(line)))
+out.close()
+"""
+
+# Rows of its input, as text
+COUNT = """#!/usr/bin/env python3
+import sys
+with open(sys.argv[2]) as in_fp:
+    print(len(in_fp.readlines()))
+"""
+
+
+def test_records_text(job):
+    job.script("calls.py", CALLS)
+    job.script("count.py", COUNT)
+    job.write("calls.py | count.py", git_out={"compress": "gz"},
+              pipeline={"records": "calls.py"})
+    job.run()
+
+    assert job.show("v3/1/stdout.gz") == "15\n"
+
+    # The text copies and the uncompressed stderr don't stay on git_out
+    assert job.untracked() == []
+
+
+def test_round_trip():
+    out_fp = io.BytesIO()
+    writer = popype.RecordWriter(out_fp, "func:str, line:int, cost:float")
+    records = [("f" + str(x), x, x / 4) for x in range(20000)]
+    for record in records:
+        writer.write(record)
+    writer.close()
+
+    reader = popype.RecordReader(io.BytesIO(out_fp.getvalue()))
+    assert reader.isrecords
+    assert reader.fields == [["func", "str"], ["line", "int"],
+                             ["cost", "float"]]
+    assert [tuple(x) for x in reader] == records
+
+
+def test_lines():
+    out_fp = io.BytesIO()
+    writer = popype.RecordWriter(out_fp, "func, line:int")
+    writer.write(("printk", 457))
+    writer.write(("", 0))
+    writer.close()
+
+    reader = popype.RecordReader(io.BytesIO(out_fp.getvalue()))
+    assert list(reader.lines()) == ["printk,457\n", ",0\n"]
+
+
+def test_empty():
+    out_fp = io.BytesIO()
+    popype.RecordWriter(out_fp, "func").close()
+
+    assert list(popype.RecordReader(io.BytesIO(out_fp.getvalue()))) == []
+
+
+def test_text():
+    # The same reader works after a stage that writes CSV text
+    text = b"printk,457,0.5\nkmalloc,12\nshort\n"
+
+    reader = popype.RecordReader(io.BytesIO(text), "func, line:int, x:float")
+    assert not reader.isrecords
+    assert list(reader) == [("printk", 457, 0.5), ("kmalloc", 12),
+                            ("short",)]
+
+    reader = popype.RecordReader(io.BytesIO(text))
+    assert list(reader.lines()) == ["printk,457,0.5\n", "kmalloc,12\n",
+                                    "short\n"]
+
+
+def test_text_shorter_than_magic():
+    reader = popype.RecordReader(io.BytesIO(b"a,1"))
+    assert list(reader) == [("a", "1")]